@@ -1,22 +1,33 @@
 import asyncio
-import traceback
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, StateFilter
 from aiogram.types import Message, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, \
-    BotCommand, FSInputFile
+    BotCommand, BotCommandScopeChat, FSInputFile, ChatMemberUpdated
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.utils.text_decorations import html_decoration
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramAPIError
 import pymysql
-from pymysql.cursors import DictCursor
+from pymysql.constants import CLIENT, ER
+from pymysql.cursors import DictCursor, SSDictCursor
 import logging
 from contextlib import contextmanager
+from operator import itemgetter
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 import io
 import csv
+import json
+import tempfile
+import re
+import time
+import threading
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import io
 logging.basicConfig(level=logging.INFO)
@@ -25,6 +36,16 @@ import sys
 import os
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # optional: faster (de)serialization of Bot API payloads
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:  # optional: faster event loop; not available on Windows
+    uvloop = None
+
 if len(sys.argv) > 1:
     env_file = sys.argv[1]
     print(f"🔌 Loading configuration from: {env_file}")
@@ -52,6 +73,54 @@ DB_CONFIG = {
 }
 
 
+class TTLCache:
+    """Small in-memory cache whose entries expire after `ttl` seconds.
+    Thread-safe: DB executor threads update entries while the event loop reads them."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                self._data.pop(key, None)
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.maxsize and key not in self._data:
+                # Drop the oldest entry to stay within maxsize
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else default
+
+
+# Group membership status per user_id, kept fresh by chat_member updates (only sent
+# while the bot is a group admin) and join/leave service messages. The short TTL
+# bounds how long a missed leave can keep handing lines to a non-member
+_member_cache = TTLCache(maxsize=50_000, ttl=30)
+
+# Bot running/stopped flag and agent profiles change rarely but are read on every line
+# request; the setters below invalidate their entry so local changes show up at once
+_status_cache = TTLCache(maxsize=1, ttl=5)
+_user_info_cache = TTLCache(maxsize=10_000, ttl=30)
+# Admin rows for fan-outs and /listadmins; add_admin/remove_admin invalidate it
+_admins_cache = TTLCache(maxsize=1, ttl=300)
+_MISSING = object()
+
+
 # FSM States
 class AdminStates(StatesGroup):
     waiting_for_numbers = State()
@@ -68,126 +137,194 @@ class UserStates(StatesGroup):
     waiting_for_call_ended_summary = State()
 
 
+# Blocking DB helpers run on a small dedicated pool. main() installs a separate bounded
+# default executor, so asyncio internals (getaddrinfo, to_thread) never queue behind
+# long exports or purges on the DB threads
+DB_WORKERS = 4
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+DEFAULT_WORKERS = 8
+DEFAULT_EXECUTOR = ThreadPoolExecutor(max_workers=DEFAULT_WORKERS, thread_name_prefix="default")
+# CPU-bound leaderboard rendering gets its own thread so it holds neither a DB worker
+# nor a default-executor slot
+RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+
+
+async def run_db(fn, *args):
+    """Run a blocking DB helper on the DB executor"""
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, fn, *args)
+
+
+# Each DB executor thread keeps one connection open and reuses it across calls
+_db_local = threading.local()
+# A connection idle longer than this is pinged before use, since MySQL's wait_timeout
+# may have closed it server-side
+DB_IDLE_PING = 60
+
+
+def _warm_db_thread(barrier):
+    with get_db_connection():
+        pass
+    # Hold this worker until the others start, so each DB thread opens its own connection
+    barrier.wait(timeout=10)
+
+
+async def warm_db_pool():
+    """Start every DB worker thread and open its connection before the first update arrives"""
+    barrier = threading.Barrier(DB_WORKERS)
+    results = await asyncio.gather(
+        *(run_db(_warm_db_thread, barrier) for _ in range(DB_WORKERS)), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning(f"DB warm-up: {result!r}")
+
+
 # Database connection context manager
 @contextmanager
 def get_db_connection():
-    connection = pymysql.connect(**DB_CONFIG)
+    connection = getattr(_db_local, 'connection', None)
+    if connection is None or not connection.open:
+        connection = pymysql.connect(**DB_CONFIG)
+        _db_local.connection = connection
+    elif time.monotonic() - _db_local.last_used > DB_IDLE_PING:
+        connection.ping(reconnect=True)
     try:
         yield connection
         connection.commit()
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+        # Connection-level failure: drop it so the next call on this thread reconnects
+        _db_local.connection = None
+        try:
+            connection.close()
+        except Exception:
+            pass
+        logging.error(f"Database error: {e}")
+        raise
     except Exception as e:
         connection.rollback()
         logging.error(f"Database error: {e}")
         raise
     finally:
-        connection.close()
+        _db_local.last_used = time.monotonic()
 
 
 # Database initialization
 def init_database():
     """Initialize database and create tables if they don't exist"""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """CREATE TABLE IF NOT EXISTS bot_status (
-                   id INT PRIMARY KEY DEFAULT 1,
-                   status VARCHAR(50) DEFAULT 'running'
-                )"""
-            )
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS no_answer_records (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    username VARCHAR(255),
-                    agent_name VARCHAR(255),
-                    reference VARCHAR(50),
-                    number VARCHAR(255),
-                    name VARCHAR(255),
-                    address TEXT,
-                    email VARCHAR(255),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_user_id (user_id),
-                    INDEX idx_created_at (created_at)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
-
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT NOT NULL UNIQUE,
-                    agent_name VARCHAR(255),
-                    reference VARCHAR(50) DEFAULT 'CB2061',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_user_id (user_id)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
-
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS number_queue (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    number VARCHAR(255) NOT NULL,
-                    name VARCHAR(255) DEFAULT NULL,
-                    address TEXT DEFAULT NULL,
-                    email VARCHAR(255) DEFAULT NULL,
-                    is_used BOOLEAN DEFAULT FALSE,
-                    is_completed BOOLEAN DEFAULT FALSE,
-                    used_by_user_id BIGINT DEFAULT NULL,
-                    used_by_username VARCHAR(255) DEFAULT NULL,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    used_at TIMESTAMP NULL DEFAULT NULL,
-                    status VARCHAR(50) DEFAULT NULL,
-                    call_summary TEXT DEFAULT NULL,
-                    summary_submitted_at TIMESTAMP NULL DEFAULT NULL,
-                    group_chat_id BIGINT DEFAULT NULL,
-                    INDEX idx_is_used (is_used),
-                    INDEX idx_is_completed (is_completed),
-                    INDEX idx_added_at (added_at),
-                    INDEX idx_user_id (used_by_user_id)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
-
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS number_requests (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    username VARCHAR(255) DEFAULT NULL,
-                    group_chat_id BIGINT NOT NULL,
-                    previous_number VARCHAR(255) DEFAULT NULL,
-                    reason VARCHAR(100) DEFAULT NULL,
-                    status VARCHAR(50) DEFAULT 'pending',
-                    requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed_at TIMESTAMP NULL DEFAULT NULL,
-                    INDEX idx_status (status),
-                    INDEX idx_user_id (user_id)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
+    ddl_statements = [
+        """
+        CREATE TABLE IF NOT EXISTS bot_status (
+            id INT PRIMARY KEY DEFAULT 1,
+            status VARCHAR(50) DEFAULT 'running'
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS no_answer_records (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username VARCHAR(255),
+            agent_name VARCHAR(255),
+            reference VARCHAR(50),
+            number VARCHAR(255),
+            name VARCHAR(255),
+            address TEXT,
+            email VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_user_id (user_id),
+            INDEX idx_created_at (created_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL UNIQUE,
+            agent_name VARCHAR(255),
+            reference VARCHAR(50) DEFAULT 'CB2061',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_user_id (user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS number_queue (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            number VARCHAR(255) NOT NULL,
+            name VARCHAR(255) DEFAULT NULL,
+            address TEXT DEFAULT NULL,
+            email VARCHAR(255) DEFAULT NULL,
+            is_used BOOLEAN DEFAULT FALSE,
+            is_completed BOOLEAN DEFAULT FALSE,
+            used_by_user_id BIGINT DEFAULT NULL,
+            used_by_username VARCHAR(255) DEFAULT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            used_at TIMESTAMP NULL DEFAULT NULL,
+            status VARCHAR(50) DEFAULT NULL,
+            call_summary TEXT DEFAULT NULL,
+            summary_submitted_at TIMESTAMP NULL DEFAULT NULL,
+            group_chat_id BIGINT DEFAULT NULL,
+            INDEX idx_is_used (is_used),
+            INDEX idx_is_completed (is_completed),
+            INDEX idx_added_at (added_at),
+            INDEX idx_user_id (used_by_user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS number_requests (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username VARCHAR(255) DEFAULT NULL,
+            group_chat_id BIGINT NOT NULL,
+            previous_number VARCHAR(255) DEFAULT NULL,
+            reason VARCHAR(100) DEFAULT NULL,
+            status VARCHAR(50) DEFAULT 'pending',
+            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP NULL DEFAULT NULL,
+            INDEX idx_status (status),
+            INDEX idx_user_id (user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS approved_new_numbers (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            approved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            used BOOLEAN DEFAULT FALSE,
+            INDEX idx_user_id (user_id),
+            INDEX idx_used (used)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS admins (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL UNIQUE,
+            username VARCHAR(255),
+            added_by BIGINT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_user_id (user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+    ]
 
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS approved_new_numbers (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    approved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    used BOOLEAN DEFAULT FALSE,
-                    INDEX idx_user_id (user_id),
-                    INDEX idx_used (used)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
+    # Send all CREATE TABLEs in one round-trip; MULTI_STATEMENTS is enabled only on
+    # this short-lived connection, never on the pooled ones
+    conn = pymysql.connect(**DB_CONFIG, client_flag=CLIENT.MULTI_STATEMENTS)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(";\n".join(ddl_statements))
+            while cursor.nextset():
+                pass
+        conn.commit()
+    finally:
+        conn.close()
 
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS admins (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT NOT NULL UNIQUE,
-                    username VARCHAR(255),
-                    added_by BIGINT NOT NULL,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_user_id (user_id)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
+    logging.info("✅ Database tables initialized successfully")
 
-            logging.info("✅ Database tables initialized successfully")
+    with get_db_connection() as conn:
+        # Check and update schema for new columns
+        check_and_update_schema(conn)
 
-            # Check and update schema for new columns
-            check_and_update_schema(conn)
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT user_id FROM admins")
+            _admin_cache['ids'] = frozenset(row['user_id'] for row in cursor.fetchall())
 
 def check_and_update_schema(conn):
     """Safely add new columns if they don't exist"""
@@ -214,26 +351,67 @@ def check_and_update_schema(conn):
             except Exception as e:
                 logging.error(f"❌ Schema update failed: {e}")
 
+        # Lets get_next_number walk free lines in added_at order instead of filesorting
+        cursor.execute("SHOW INDEX FROM number_queue WHERE Key_name = 'idx_next_free'")
+        if not cursor.fetchone():
+            logging.info("⚙️ Updating schema: Adding idx_next_free index...")
+            try:
+                cursor.execute("ALTER TABLE number_queue ADD INDEX idx_next_free (is_used, added_at)")
+                conn.commit()
+                logging.info("✅ Schema updated successfully!")
+            except Exception as e:
+                logging.error(f"❌ Schema update failed: {e}")
+
+        # Covers the "agent's open line" lookups (has_active_line, get_user_record incl. its ORDER BY)
+        cursor.execute("SHOW INDEX FROM number_queue WHERE Key_name = 'idx_user_active'")
+        if not cursor.fetchone():
+            logging.info("⚙️ Updating schema: Adding idx_user_active index...")
+            try:
+                cursor.execute(
+                    "ALTER TABLE number_queue ADD INDEX idx_user_active (used_by_user_id, is_used, is_completed, used_at, id)"
+                )
+                conn.commit()
+                logging.info("✅ Schema updated successfully!")
+            except Exception as e:
+                logging.error(f"❌ Schema update failed: {e}")
+
+        cursor.execute("SHOW COLUMNS FROM number_queue LIKE 'status_history'")
+        if not cursor.fetchone():
+            logging.info("⚙️ Updating schema: Adding status_history column...")
+            try:
+                cursor.execute("ALTER TABLE number_queue ADD COLUMN status_history TEXT DEFAULT NULL")
+                conn.commit()
+                logging.info("✅ Schema updated successfully!")
+            except Exception as e:
+                logging.error(f"❌ Schema update failed: {e}")
+
 def save_agent_name(user_id, agent_name, username): # <--- Added username parameter
     """Save or update agent name and username for user"""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
-                """INSERT INTO users (user_id, agent_name, username, reference) 
-                   VALUES (%s, %s, %s, 'CB2061') 
-                   ON DUPLICATE KEY UPDATE agent_name = %s, username = %s""",
-                (user_id, agent_name, username, agent_name, username)
+                # reference comes from the column DEFAULT, so the statement text never varies
+                """INSERT INTO users (user_id, agent_name, username) 
+                   VALUES (%s, %s, %s) 
+                   ON DUPLICATE KEY UPDATE agent_name = VALUES(agent_name), username = VALUES(username)""",
+                (user_id, agent_name, username)
             )
+    _user_info_cache.pop(user_id)
 
 def get_user_info(user_id):
     """Get agent name and reference for user"""
+    user_info = _user_info_cache.get(user_id, _MISSING)
+    if user_info is not _MISSING:
+        return user_info
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 "SELECT agent_name, reference FROM users WHERE user_id = %s",
                 (user_id,)
             )
-            return cursor.fetchone()
+            user_info = cursor.fetchone()
+    _user_info_cache.set(user_id, user_info)
+    return user_info
 
 def save_no_answer_record(user_id, username, agent_name, reference, number, name, address, email):
     """Save no answer record for export"""
@@ -246,15 +424,6 @@ def save_no_answer_record(user_id, username, agent_name, reference, number, name
                 (user_id, username, agent_name, reference, number, name, address, email)
             )
 
-def increment_score(user_id):
-    """Add 1 point to the user's score"""
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "UPDATE users SET score = score + 1 WHERE user_id = %s",
-                (user_id,)
-            )
-
 def get_leaderboard_data():
     """Get top 10 agents by score"""
     with get_db_connection() as conn:
@@ -265,41 +434,82 @@ def get_leaderboard_data():
             )
             return cursor.fetchall()
 
-def is_admin(user_id):
-    """Check if user is an admin (master or regular)"""
-    if user_id == ADMIN_ID:
-        return True
+# In-memory copy of admins.user_id, loaded by init_database, kept current by
+# add_admin/remove_admin and reloaded every ADMIN_REFRESH_INTERVAL seconds by
+# admin_refresher so admins added by another bot process sharing the database are
+# picked up. Admin checks never touch the DB.
+ADMIN_REFRESH_INTERVAL = 60
+# 'gen' is bumped by every local add/remove; a refresh whose read started before one
+# of those is discarded rather than overwriting the newer set
+_admin_cache = {'ids': frozenset(), 'gen': 0}
+_admin_lock = threading.Lock()
+
+def _refresh_admin_ids():
+    with _admin_lock:
+        gen = _admin_cache['gen']
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT id FROM admins WHERE user_id = %s", (user_id,))
-            return cursor.fetchone() is not None
+            cursor.execute("SELECT user_id FROM admins")
+            ids = frozenset(row['user_id'] for row in cursor.fetchall())
+    with _admin_lock:
+        if _admin_cache['gen'] == gen:
+            _admin_cache['ids'] = ids
+
+async def admin_refresher():
+    while True:
+        await asyncio.sleep(ADMIN_REFRESH_INTERVAL)
+        try:
+            await run_db(_refresh_admin_ids)
+        except Exception as e:
+            # Keep serving the previous set rather than locking admins out
+            logging.error(f"Failed to refresh admin list: {e}")
+
+def is_admin(user_id):
+    """Check if user is an admin (master or regular)"""
+    return user_id == ADMIN_ID or user_id in _admin_cache['ids']
 
 def is_master_admin(user_id):
     """Check if user is the master admin"""
     return user_id == ADMIN_ID
 
 def add_admin(user_id, username, added_by):
-    """Add a new admin"""
+    """Add a new admin; returns 0 if they already were one"""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
-                "INSERT INTO admins (user_id, username, added_by) VALUES (%s, %s, %s)",
+                "INSERT IGNORE INTO admins (user_id, username, added_by) VALUES (%s, %s, %s)",
                 (user_id, username, added_by)
             )
+            added = cursor.rowcount
+    with _admin_lock:
+        _admin_cache['ids'] = _admin_cache['ids'] | {user_id}
+        _admin_cache['gen'] += 1
+    _admins_cache.pop('admins')
+    return added
 
 def remove_admin(user_id):
     """Remove an admin"""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM admins WHERE user_id = %s", (user_id,))
-            return cursor.rowcount
+            removed = cursor.rowcount
+    with _admin_lock:
+        _admin_cache['ids'] = _admin_cache['ids'] - {user_id}
+        _admin_cache['gen'] += 1
+    _admins_cache.pop('admins')
+    return removed
 
 def get_all_admins():
     """Get list of all admins"""
+    admins = _admins_cache.get('admins')
+    if admins is not None:
+        return admins
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("SELECT user_id, username, added_at FROM admins ORDER BY added_at")
-            return cursor.fetchall()
+            admins = cursor.fetchall()
+    _admins_cache.set('admins', admins)
+    return admins
 
 
 # Database functions
@@ -362,47 +572,206 @@ def get_user_record(user_id: int):
             return result if result else None
 
 
-def mark_line_completed(user_id):
-    """Mark a line as permanently completed"""
+def has_active_line(user_id: int) -> bool:
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
-                "UPDATE number_queue SET is_completed = TRUE WHERE used_by_user_id = %s and is_used = True",
-                (user_id,)
+                """
+                SELECT 1 FROM number_queue
+                WHERE used_by_user_id = %s
+                  AND is_used = TRUE
+                  AND is_completed = FALSE
+                LIMIT 1
+                """,
+                (user_id,),
             )
+            return cursor.fetchone() is not None
+
+
+def complete_lines_batch(items):
+    """
+    Apply a batch of line completions in one transaction.
+    items: list of (user_id, summary or None, add_score, status history or None)
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            # Final status + the in-memory transitions go to the still-open line in one write
+            histories = {user_id: history for user_id, _, _, history in items if history}
+            if histories:
+                status_cases = " ".join(["WHEN %s THEN %s"] * len(histories))
+                history_cases = " ".join(["WHEN %s THEN %s"] * len(histories))
+                placeholders = ", ".join(["%s"] * len(histories))
+                cursor.execute(
+                    f"""UPDATE number_queue 
+                        SET status = CASE used_by_user_id {status_cases} END, 
+                            status_history = CASE used_by_user_id {history_cases} END 
+                        WHERE used_by_user_id IN ({placeholders}) AND is_used = TRUE AND is_completed = FALSE""",
+                    [v for user_id, history in histories.items() for v in (user_id, history[-1][1])]
+                    + [v for user_id, history in histories.items() for v in (user_id, json.dumps(history))]
+                    + list(histories)
+                )
+
+            # Latest summary wins if a user shows up twice in the batch
+            summaries = {user_id: summary for user_id, summary, _, _ in items if summary is not None}
+            if summaries:
+                cases = " ".join(["WHEN %s THEN %s"] * len(summaries))
+                placeholders = ", ".join(["%s"] * len(summaries))
+                cursor.execute(
+                    f"""UPDATE number_queue 
+                        SET call_summary = CASE used_by_user_id {cases} END, summary_submitted_at = NOW() 
+                        WHERE used_by_user_id IN ({placeholders})""",
+                    [v for pair in summaries.items() for v in pair] + list(summaries)
+                )
+
+            user_ids = list({user_id for user_id, _, _, _ in items})
+            placeholders = ", ".join(["%s"] * len(user_ids))
             cursor.execute(
-                "DELETE FROM number_requests WHERE user_id = %s AND status IN ('pending', 'approved')",
-                (user_id,)
+                f"UPDATE number_queue SET is_completed = TRUE WHERE used_by_user_id IN ({placeholders}) and is_used = True",
+                user_ids
+            )
+            cursor.execute(
+                f"DELETE FROM number_requests WHERE user_id IN ({placeholders}) AND status IN ('pending', 'approved')",
+                user_ids
             )
 
+            scores = {}
+            for user_id, _, add_score, _ in items:
+                if add_score:
+                    scores[user_id] = scores.get(user_id, 0) + 1
+            if scores:
+                cases = " ".join(["WHEN %s THEN %s"] * len(scores))
+                placeholders = ", ".join(["%s"] * len(scores))
+                cursor.execute(
+                    f"UPDATE users SET score = score + CASE user_id {cases} ELSE 0 END WHERE user_id IN ({placeholders})",
+                    [v for pair in scores.items() for v in pair] + list(scores)
+                )
+
+
+# Line completions from the summary handlers go through a single writer task
+# that coalesces whatever is pending into one transaction
+_write_queue = asyncio.Queue()
+WRITE_BATCH_SIZE = 100
+
+
+async def db_writer():
+    while True:
+        batch = [await _write_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE and not _write_queue.empty():
+            batch.append(_write_queue.get_nowait())
+
+        try:
+            await run_db(complete_lines_batch, [item[:4] for item in batch])
+        except Exception as e:
+            logging.error(f"Batched line completion failed: {e}")
+            if len(batch) == 1:
+                _resolve(batch[0][-1], e)
+            else:
+                # One bad item shouldn't fail everyone's line: retry each on its own
+                # and only fail the ones whose own write fails
+                for item in batch:
+                    await _complete_single(item)
+        else:
+            for *_, done in batch:
+                _resolve(done)
+
+
+def _resolve(done, error=None):
+    if done.done():
+        return
+    if error is None:
+        done.set_result(None)
+    else:
+        done.set_exception(error)
+
+
+async def _complete_single(item):
+    try:
+        await run_db(complete_lines_batch, [item[:4]])
+    except Exception as e:
+        logging.error(f"Line completion for {item[0]} failed: {e}")
+        _resolve(item[-1], e)
+    else:
+        _resolve(item[-1])
+
+
+async def complete_line(user_id: int, summary: str = None, add_score: bool = True):
+    """Mark the user's line completed (optionally saving a summary / scoring) and wait for the commit"""
+    history = _line_status.pop(user_id, None)
+    done = asyncio.get_running_loop().create_future()
+    await _write_queue.put((user_id, summary, add_score, history, done))
+    try:
+        await done
+    except Exception:
+        # The line is still open, so put its trail back ahead of anything tracked since
+        if history:
+            _line_status[user_id] = history + _line_status.get(user_id, [])
+        raise
+
+
+# Status transitions of each agent's open line (OTP, Need Email, ...), kept in memory
+# and written once with the final status when the line is completed
+_line_status = {}
+
+
+def track_status(user_id: int, status: str):
+    _line_status.setdefault(user_id, []).append((time.time(), status))
+
+
+# get_next_number's result when the agent already holds an open line
+HAS_OPEN_LINE = object()
+CLAIM_ATTEMPTS = 3
+
+
 def get_next_number(user_id: int, username: str = None, force_new: bool = False):
     """
-    Get next available number for user
+    Get next available number for user; returns the claimed row, None if the queue is
+    empty, or HAS_OPEN_LINE if the agent already has a line (unless force_new)
     force_new: If True, ignore existing assignment check (for "request another line")
     """
+    for attempt in range(CLAIM_ATTEMPTS):
+        try:
+            return _claim_next_number(user_id, username, force_new)
+        except pymysql.err.OperationalError as e:
+            # Two claims whose open-line locks cover the same index gap deadlock on the
+            # UPDATE; InnoDB rolls one back, so rerun it (it now sees the winner's commit)
+            if e.args[0] != ER.LOCK_DEADLOCK or attempt == CLAIM_ATTEMPTS - 1:
+                raise
+
+
+def _claim_next_number(user_id, username, force_new):
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             # Only check for existing if force_new is False
             if not force_new:
+                # Locking read on idx_user_active: a concurrent claim for the same agent
+                # waits here for the first one to commit and then sees its line, where a
+                # plain read would answer from an older snapshot
                 cursor.execute(
-                    "SELECT number FROM number_queue WHERE used_by_user_id = %s AND is_used = TRUE AND is_completed = FALSE LIMIT 1",
+                    """SELECT number FROM number_queue
+                       WHERE used_by_user_id = %s AND is_used = TRUE AND is_completed = FALSE
+                       LIMIT 1
+                       FOR UPDATE""",
                     (user_id,)
                 )
                 existing = cursor.fetchone()
 
                 if existing:
-                    return None
-
+                    return HAS_OPEN_LINE
             # Get first unused number - EXCLUDE COMPLETED
+            # The agent's name/reference ride along as subqueries so the caller needs no
+            # second round-trip; FOR UPDATE doesn't extend into them, so users isn't locked
             cursor.execute(
                 """SELECT id, number, name, address, email, added_at,
-                          card_holder, card_number, card_expiry, cvv, sortcode, account_number, bin_info, dob, mmn
+                          card_holder, card_number, card_expiry, cvv, sortcode, account_number, bin_info, dob, mmn,
+                          (SELECT agent_name FROM users WHERE user_id = %s) AS agent_name,
+                          (SELECT reference FROM users WHERE user_id = %s) AS reference
                    FROM number_queue
                    WHERE is_used = FALSE
                    AND name IS NOT NULL AND name != ''
                    ORDER BY added_at ASC
                    LIMIT 1
-                   FOR UPDATE SKIP LOCKED"""
+                   FOR UPDATE SKIP LOCKED""",
+                (user_id, user_id)
             )
             result = cursor.fetchone()
 
@@ -421,28 +790,6 @@ def get_next_number(user_id: int, username: str = None, force_new: bool = False)
             return None
 
 
-
-
-def update_record_status(user_id: int, status: str):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "UPDATE number_queue SET status = %s WHERE used_by_user_id = %s",
-                (status, user_id)
-            )
-
-
-def update_record_summary(user_id: int, summary: str):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """UPDATE number_queue 
-                   SET call_summary = %s, summary_submitted_at = NOW() 
-                   WHERE used_by_user_id = %s""",
-                (summary, user_id)
-            )
-
-
 def create_line_request(user_id: int, username: str):
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
@@ -475,36 +822,73 @@ def update_request_status(request_id: int, status: str):
                 (status, request_id)
             )
 
-def export_no_answer_records():
-    """Export all no answer records"""
+
+def decline_request(request_id: int):
+    """Drop a pending request in one statement; returns 0 if it was already processed"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM number_requests WHERE id = %s AND status = 'pending'",
+                (request_id,)
+            )
+            return cursor.rowcount
+
+
+def approve_after_decline(request_id: int, user_id: int):
+    """Undo a decline in one transaction: mark the user's old line(s) unused so they can
+    request a new one, and set the request to approved"""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
+            cursor.execute(
+                """UPDATE number_queue 
+                   SET is_used = FALSE, 
+                       used_by_user_id = NULL, 
+                       used_by_username = NULL,
+                       status = NULL,
+                       call_summary = NULL
+                   WHERE used_by_user_id = %s""",
+                (user_id,)
+            )
+            cursor.execute(
+                """UPDATE number_requests 
+                   SET status = 'approved', processed_at = NOW() 
+                   WHERE id = %s""",
+                (request_id,)
+            )
+
+def export_no_answer_records(path):
+    """Export all no answer records as a UTF-8 CSV at `path`, then delete them"""
+    with get_db_connection() as conn, open(path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["User ID", "Username", "Agent Name", "Reference", "Number", "Name", "Address", "Email", "Date"])
+        header_end = output.tell()
+
+        # Server-side cursor: rows stream from MySQL instead of being fetched all at once.
+        # FOR UPDATE locks the scanned rows and gaps until the DELETE below commits, so a
+        # record inserted mid-export waits instead of being deleted unexported
+        with conn.cursor(SSDictCursor) as cursor:
             cursor.execute("""
                 SELECT user_id, username, agent_name, reference, number, name, 
                        address, email, created_at 
                 FROM no_answer_records 
                 ORDER BY created_at DESC
+                FOR UPDATE
             """)
-            results = cursor.fetchall()
-
-            if not results:
-                return None, 0
-
-            output = io.StringIO()
-            output.write("User ID,Username,Agent Name,Reference,Number,Name,Address,Email,Date\n")
-            for row in results:
-                name = row['name'] if row['name'] else "-"
-                address = row['address'].replace('"', '""') if row['address'] else "-"
-                email = row['email'] if row['email'] else "-"
-                output.write(
-                    f"{row['user_id']},{row['username']},{row['agent_name']},{row['reference']},{row['number']},{name},\"{address}\",{email},{row['created_at']}\n"
-                )
+            writer.writerows(
+                (row['user_id'], row['username'], row['agent_name'], row['reference'], row['number'],
+                 row['name'] or "-", row['address'] or "-", row['email'] or "-", row['created_at'])
+                for row in cursor
+            )
+
+        if output.tell() == header_end:
+            return False, 0
 
+        with conn.cursor() as cursor:
             # Delete exported records
             cursor.execute("DELETE FROM no_answer_records")
             deleted_count = cursor.rowcount
 
-            return output.getvalue(), deleted_count
+        return True, deleted_count
 
 def get_queue_stats():
     with get_db_connection() as conn:
@@ -553,132 +937,326 @@ def clear_queue():
             return cursor.rowcount
 
 
-def export_used_numbers():
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
+def export_used_numbers(path):
+    """Write the CSV of completed lines to `path`; returns (rows exported, highest exported id) -
+    purging is done separately, by id range, so no per-row ids are kept"""
+    with get_db_connection() as conn, open(path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["Number", "Name", "Address", "Email", "Used By", "User ID", "Status", "Summary", "Used At", "Summary At"])
+        exported = 0
+        max_id = 0
+
+        with conn.cursor(SSDictCursor) as cursor:
             # Export COMPLETED lines
             cursor.execute(
-                """SELECT number, name, address, email, used_by_username, used_by_user_id, 
+                """SELECT id, number, name, address, email, used_by_username, used_by_user_id, 
                    status, call_summary, used_at, summary_submitted_at 
                    FROM number_queue 
                    WHERE is_completed = TRUE
                    ORDER BY used_at"""
             )
-            results = cursor.fetchall()
-
-            if not results:
-                return None, 0
-
-            output = io.StringIO()
-            output.write("Number,Name,Address,Email,Used By,User ID,Status,Summary,Used At,Summary At\n")
-            for row in results:
-                status = row['status'] if row['status'] else "-"
-                summary = row['call_summary'].replace('"', '""') if row['call_summary'] else "-"
-                summary_at = row['summary_submitted_at'] if row['summary_submitted_at'] else "-"
-                output.write(
-                    f"{row['number']},{row['name']},\"{row['address']}\",{row['email']},{row['used_by_username']},{row['used_by_user_id']},{status},\"{summary}\",{row['used_at']},{summary_at}\n")
-
-            # Delete COMPLETED lines
-            cursor.execute("DELETE FROM number_queue WHERE is_completed = TRUE")
-            deleted_count = cursor.rowcount
+            def csv_rows():
+                nonlocal exported, max_id
+                for row in cursor:
+                    exported += 1
+                    max_id = max(max_id, row['id'])
+                    yield (row['number'], row['name'], row['address'], row['email'], row['used_by_username'],
+                           row['used_by_user_id'], row['status'] or "-", row['call_summary'] or "-",
+                           row['used_at'], row['summary_submitted_at'] or "-")
 
-            return output.getvalue(), deleted_count
+            writer.writerows(csv_rows())
 
+        return exported, max_id
 
-def export_unused_numbers():
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            # Export UNUSED lines (remaining in queue)
-            cursor.execute("""
-                SELECT number, name, address, email 
-                FROM number_queue 
-                WHERE is_used = FALSE AND is_completed = FALSE
-                ORDER BY id
-            """)
-            results = cursor.fetchall()
 
-            if not results:
-                return None, 0
+def export_callbacks(path):
+    """Write all callback records to `path` as CSV; returns False if there were none"""
+    with get_db_connection() as conn, open(path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output)
+        writer.writerow(['User ID', 'Username', 'Number', 'Name', 'Address', 'Email', 'Summary', 'Date'])
+        header_end = output.tell()
+
+        with conn.cursor(SSDictCursor) as cursor:
+            cursor.execute(
+                """SELECT user_id, username, number, name, address, email, call_summary, created_at 
+                   FROM call_backs ORDER BY created_at DESC"""
+            )
+            writer.writerows(
+                (cb['user_id'], cb['username'], cb['number'], cb['name'], cb['address'],
+                 cb['email'], cb['call_summary'], cb['created_at'])
+                for cb in cursor
+            )
+
+        return output.tell() != header_end
 
-            output = io.StringIO()
-            output.write("Number,Name,Address,Email\n")
-            for row in results:
-                name = row['name'] if row['name'] else "-"
-                address = row['address'] if row['address'] else "-"
-                email = row['email'] if row['email'] else "-"
-                output.write(f"{row['number']},{name},\"{address}\",{email}\n")
 
-            return output.getvalue(), 0
+@contextmanager
+def export_tempfile():
+    """Temporary path for an export; the CSV is streamed to disk and uploaded from
+    there instead of being held in memory"""
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 
+PURGE_BATCH_SIZE = 5000
 
 
-def export_all_numbers():
+def delete_completed_lines(max_id):
+    """Delete one batch of exported completed lines (id <= max_id); returns the rows deleted"""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT number, name, address, email, is_used, used_by_username, 
-                       used_by_user_id, status, call_summary, used_at, added_at 
-                FROM number_queue 
-                ORDER BY id
-            """)
-            results = cursor.fetchall()
-
-            if not results:
-                return None, 0
-
-            output = io.StringIO()
-            output.write("Number,Name,Address,Email,Used,Username,User ID,Status,Summary,Used At,Added At\n")
-            for row in results:
-                used = "Yes" if row['is_used'] else "No"
-                name = row['name'] if row['name'] else "-"
-                address = row['address'] if row['address'] else "-"
-                email = row['email'] if row['email'] else "-"
-                username = row['used_by_username'] if row['used_by_username'] else "-"
-                user_id = row['used_by_user_id'] if row['used_by_user_id'] else "-"
-                status = row['status'] if row['status'] else "-"
-                summary = row['call_summary'].replace('"', '""') if row['call_summary'] else "-"
-                used_at = row['used_at'] if row['used_at'] else "-"
-                output.write(
-                    f"{row['number']},{name},\"{address}\",{email},{used},{username},{user_id},{status},\"{summary}\",{used_at},{row['added_at']}\n")
+            cursor.execute(
+                "DELETE FROM number_queue WHERE is_completed = TRUE AND id <= %s LIMIT %s",
+                (max_id, PURGE_BATCH_SIZE)
+            )
+            return cursor.rowcount
 
-            cursor.execute("DELETE FROM number_queue")
-            deleted_count = cursor.rowcount
 
-            return output.getvalue(), deleted_count
+# Held from /export_used until its purge finishes, so a second export can't pick up
+# the same completed lines again
+_export_used_lock = asyncio.Lock()
 
 
-async def get_user_avatar_image(bot: Bot, user_id: int):
-    """Downloads user profile photo and returns PIL Image"""
+async def purge_completed_lines(max_id):
+    """Delete exported lines in small batches so the admin's export isn't held up"""
+    deleted = 0
     try:
-        photos = await bot.get_user_profile_photos(user_id, limit=1)
-        if not photos.photos:
-            return None  # User has no photo or privacy hidden
+        while True:
+            batch = await run_db(delete_completed_lines, max_id)
+            deleted += batch
+            if batch < PURGE_BATCH_SIZE:
+                break
+            await asyncio.sleep(0.1)
+        logging.info(f"🗑️ Purged {deleted} exported lines")
+    except Exception as e:
+        logging.error(f"Purge of exported lines failed: {e}")
+    finally:
+        _export_used_lock.release()
 
-        # Get the largest version of the photo
-        photo_file_id = photos.photos[0][-1].file_id
-        file_info = await bot.get_file(photo_file_id)
 
-        # Download content
-        f = io.BytesIO()
-        await bot.download_file(file_info.file_path, f)
-        f.seek(0)
+# Keep references to fire-and-forget tasks so they aren't garbage collected mid-run
+_background_tasks = set()
 
-        return Image.open(f).convert("RGBA")
-    except Exception as e:
-        logging.warning(f"Could not fetch avatar for {user_id}: {e}")
-        return None
 
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
-def generate_leaderboard_image(leaders_data):
-    TEMPLATE_PATH = "template.png"
 
-    # --- COLORS ---
-    COLOR_TOP_NAME = (255, 255, 255)
-    COLOR_TOP_SCORE = (255, 215, 0)
-    COLOR_LIST_TEXT = (50, 20, 0)
+# Fire-and-forget messages (group announcements, admin fan-out, request outcome DMs)
+# go through one outbox drained by a few workers, so handlers never wait on the Bot
+# API and the bot stays under Telegram's ~30 msg/s overall and ~1 msg/s per chat limits
+OUTBOX = asyncio.Queue(maxsize=10000)
+OUTBOX_WORKERS = 8
+BOT_API_CONNECTIONS = 200
+BOT_API_TIMEOUT = 30
+OUTBOX_RATE = 30
+PER_CHAT_INTERVAL = 1.0
 
-    try:
-        # CHANGED: Must be RGBA to handle transparency for round avatars
+
+class RateLimiter:
+    """Spaces acquisitions at least `interval` seconds apart. Slots are reserved
+    synchronously, so it needs no lock on a single event loop."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_at = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self._next_at - now
+        self._next_at = max(now, self._next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_global_limiter = RateLimiter(1 / OUTBOX_RATE)
+_chat_limiters = {}
+
+
+def enqueue_message(chat_id: int, text: str, **kwargs):
+    """Queue a send_message call; dropped (and logged) if the outbox is full"""
+    try:
+        OUTBOX.put_nowait((chat_id, text, kwargs))
+    except asyncio.QueueFull:
+        logging.error(f"Outbox full, dropping message to {chat_id}: {text[:50]}")
+
+
+def notify_group(text: str):
+    """Queue an HTML message for the agents group"""
+    enqueue_message(GROUP_CHAT_ID, text, parse_mode="HTML")
+
+
+# Routine one-line status notices are batched into one group message per interval
+# instead of one message each
+GROUP_DIGEST_INTERVAL = 2.0
+MAX_MESSAGE_LENGTH = 4096
+_group_digest = []
+
+
+def notify_group_digest(line: str):
+    """Queue a short status line for the next group digest"""
+    _group_digest.append(line)
+
+
+async def group_digest_flusher():
+    while True:
+        await asyncio.sleep(GROUP_DIGEST_INTERVAL)
+        if not _group_digest:
+            continue
+        lines = _group_digest[:]
+        _group_digest.clear()
+        chunk = []
+        size = 0
+        for line in lines:
+            if chunk and size + len(line) + 1 > MAX_MESSAGE_LENGTH:
+                notify_group("\n".join(chunk))
+                chunk, size = [], 0
+            chunk.append(line)
+            size += len(line) + 1
+        notify_group("\n".join(chunk))
+
+
+async def outbox_worker(bot: Bot):
+    while True:
+        chat_id, text, kwargs = await OUTBOX.get()
+        limiter = _chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = _chat_limiters[chat_id] = RateLimiter(PER_CHAT_INTERVAL)
+        # Per-chat slot first: it is reserved in dequeue order, which keeps a chat's
+        # messages in order even though several workers drain the queue
+        await limiter.acquire()
+        while True:
+            await _global_limiter.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except TelegramRetryAfter as e:
+                # Flood control: wait out the ban rather than hammering the API and extending it
+                logging.warning(f"Outbox rate limited, pausing {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramAPIError as e:
+                logging.error(f"Error sending to {chat_id}: {e}")
+            except Exception:
+                logging.exception(f"Error sending to {chat_id}")
+            break
+
+
+def export_unused_numbers(path):
+    with get_db_connection() as conn, open(path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["Number", "Name", "Address", "Email"])
+        header_end = output.tell()
+
+        with conn.cursor(SSDictCursor) as cursor:
+            # Export UNUSED lines (remaining in queue)
+            cursor.execute("""
+                SELECT number, name, address, email 
+                FROM number_queue 
+                WHERE is_used = FALSE AND is_completed = FALSE
+                ORDER BY id
+            """)
+            writer.writerows(
+                (row['number'], row['name'] or "-", row['address'] or "-", row['email'] or "-")
+                for row in cursor
+            )
+
+        if output.tell() == header_end:
+            return False, 0
+
+        return True, 0
+
+
+
+def export_all_numbers(path):
+    with get_db_connection() as conn, open(path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["Number", "Name", "Address", "Email", "Used", "Username", "User ID", "Status", "Summary", "Used At", "Added At"])
+        header_end = output.tell()
+
+        # Bound the export and the delete by the highest id at the start instead of locking
+        # the queue: row locks held for the whole stream would leave agents with an
+        # "empty" queue and stall line completions. Rows added mid-export are kept.
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT MAX(id) AS max_id FROM number_queue")
+            max_id = cursor.fetchone()['max_id']
+        if max_id is None:
+            return False, 0
+
+        with conn.cursor(SSDictCursor) as cursor:
+            cursor.execute("""
+                SELECT number, name, address, email, is_used, used_by_username, 
+                       used_by_user_id, status, call_summary, used_at, added_at 
+                FROM number_queue 
+                WHERE id <= %s
+                ORDER BY id
+            """, (max_id,))
+            writer.writerows(
+                (row['number'], row['name'] or "-", row['address'] or "-", row['email'] or "-",
+                 "Yes" if row['is_used'] else "No", row['used_by_username'] or "-",
+                 row['used_by_user_id'] or "-", row['status'] or "-", row['call_summary'] or "-",
+                 row['used_at'] or "-", row['added_at'])
+                for row in cursor
+            )
+
+        if output.tell() == header_end:
+            return False, 0
+
+        # Close the read transaction, then delete in short batches so no lock is held long
+        conn.commit()
+        deleted_count = 0
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute("DELETE FROM number_queue WHERE id <= %s LIMIT %s", (max_id, PURGE_BATCH_SIZE))
+                conn.commit()
+                deleted_count += cursor.rowcount
+                if cursor.rowcount < PURGE_BATCH_SIZE:
+                    break
+
+        return True, deleted_count
+
+
+async def get_user_avatar_image(bot: Bot, user_id: int):
+    """Downloads user profile photo and returns PIL Image"""
+    try:
+        photos = await bot.get_user_profile_photos(user_id, limit=1)
+        if not photos.photos:
+            return None  # User has no photo or privacy hidden
+
+        # Get the largest version of the photo
+        photo_file_id = photos.photos[0][-1].file_id
+        file_info = await bot.get_file(photo_file_id)
+
+        # Download content
+        f = io.BytesIO()
+        await bot.download_file(file_info.file_path, f)
+        f.seek(0)
+
+        return Image.open(f).convert("RGBA")
+    except Exception as e:
+        logging.warning(f"Could not fetch avatar for {user_id}: {e}")
+        return None
+
+
+def generate_leaderboard_image(leaders_data):
+    TEMPLATE_PATH = "template.png"
+
+    # --- COLORS ---
+    COLOR_TOP_NAME = (255, 255, 255)
+    COLOR_TOP_SCORE = (255, 215, 0)
+    COLOR_LIST_TEXT = (50, 20, 0)
+
+    try:
+        # CHANGED: Must be RGBA to handle transparency for round avatars
         img = Image.open(TEMPLATE_PATH).convert("RGBA")
         draw = ImageDraw.Draw(img)
         W, H = img.size
@@ -809,63 +1387,148 @@ def create_fallback_image(text):
 router = Router()
 
 
-async def set_bot_commands(bot: Bot):
-    """Set up bot command menus for different user types"""
-    from aiogram.types import BotCommandScopeChat
-
-    # Commands for ADMIN
-    admin_commands = [
-        BotCommand(command="start", description="Start the bot"),
-        BotCommand(command="line", description="Request a new line"),
-        BotCommand(command="leaderboard", description="🏆 View Top Agents"), # <--- ADDED THIS
-        BotCommand(command="resetleaderboard", description="reset leaderboard (makes score to 0)"), # <--- ADDED THIS
-        BotCommand(command="add", description="Add numbers manually"),
-        BotCommand(command="done", description="Confirm numbers addition"),
-        BotCommand(command="upload", description="Upload CSV/TXT file"),
-        BotCommand(command="addadmin", description="Add new admin (Master only)"),
-        BotCommand(command="removeadmin", description="Remove admin (Master only)"),
-        BotCommand(command="listadmins", description="List all admins"),
-        BotCommand(command="stats", description="View queue statistics"),
-        BotCommand(command="reset", description="Reset all numbers"),
-        BotCommand(command="clear", description="Delete all numbers"),
-        BotCommand(command="clearrequests", description="Clear pending requests"),
-        BotCommand(command="export_used", description="Export used numbers"),
-        BotCommand(command="export_unused", description="Export unused numbers"),
-        BotCommand(command="export_all", description="Export all data"),
-        BotCommand(command="export_no_answer", description="Export no answer records"),
-        BotCommand(command="export_callbacks", description="Export callback records"),
-        BotCommand(command="stop", description="Stop the bot"),
-    ]
+async def get_member_status(bot: Bot, user_id: int) -> str:
+    """Return the user's status in the group, using the cache when possible"""
+    status = _member_cache.get(user_id)
+    if status is None:
+        member = await bot.get_chat_member(GROUP_CHAT_ID, user_id)
+        status = member.status
+        _member_cache.set(user_id, status)
+    return status
 
-    # Commands for REGULAR USERS
-    user_commands = [
-        BotCommand(command="start", description="Start the bot"),
-        BotCommand(command="leaderboard", description="🏆 View Top Agents"), # <--- ADDED THIS
-    ]
 
-    # Set commands for master admin
-    await bot.set_my_commands(
-        admin_commands,
-        scope=BotCommandScopeChat(chat_id=ADMIN_ID)
-    )
+@lru_cache(maxsize=4096)
+def _mention(user_id: int, name: str) -> str:
+    return html_decoration.link(value=html_decoration.quote(name), link=f"tg://user?id={user_id}")
+
+
+def mention_html(user) -> str:
+    """Same as User.mention_html(), memoized per (id, name) for repeat agents"""
+    return _mention(user.id, user.full_name)
+
+
+# Upper bound for best-effort Bot API calls (notices, command menus) so a stuck
+# request can't hold a handler open
+API_CALL_TIMEOUT = 5
+
+
+async def best_effort(what: str, call, *args, **kwargs):
+    """Run a Bot API call, call(*args, **kwargs), whose failure shouldn't fail the handler.
+    Waits out one flood-control ban and retries once; logs and returns None on any other
+    error or a second ban"""
+    for attempt in range(2):
+        try:
+            return await asyncio.wait_for(call(*args, **kwargs), timeout=API_CALL_TIMEOUT)
+        except TelegramRetryAfter as e:
+            if attempt:
+                logging.warning(f"{what} failed: still rate limited ({e.retry_after}s)")
+                return None
+            logging.warning(f"{what} rate limited, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except (asyncio.TimeoutError, TelegramAPIError) as e:
+            logging.warning(f"{what} failed: {e!r}")
+            return None
+
+
+@router.chat_member(F.chat.id == GROUP_CHAT_ID)
+async def on_group_member_update(event: ChatMemberUpdated):
+    """Keep the membership cache in sync with joins/leaves/kicks"""
+    _member_cache.set(event.new_chat_member.user.id, event.new_chat_member.status)
+
+
+async def get_summary_ctx(message: Message, state: FSMContext):
+    """(user_id, need_pass) for a summary state; None (state cleared, user told) if it's missing"""
+    data = await state.get_data()
+    ctx = data.get('ctx')
+    if ctx is None and data.get('user_id') is not None:
+        # State set before ctx was introduced
+        ctx = (data['user_id'], data.get('need_pass', False))
+    if ctx is None:
+        await state.clear()
+        await message.answer("⚠️ Couldn't find the line for this summary. Please tap the line's button again.")
+    return ctx
+
+
+# /cancel handlers are registered ahead of the states' text handlers so the
+# dispatcher routes the command here and those handlers never see it
+@router.message(
+    StateFilter(AdminStates.waiting_for_forward, AdminStates.waiting_for_remove_forward,
+                UserStates.waiting_for_agent_name, UserStates.waiting_for_finishing_summary),
+    Command("cancel")
+)
+async def cancel_flow(message: Message, state: FSMContext):
+    await state.clear()
+    await message.answer("❌ Cancelled.")
+
+
+@router.message(
+    StateFilter(UserStates.waiting_for_summary, UserStates.waiting_for_call_ended_summary,
+                UserStates.waiting_for_callback_summary),
+    Command("cancel")
+)
+async def cancel_line_summary(message: Message, state: FSMContext):
+    """Cancelling a summary still closes the line, just without scoring it"""
+    ctx = await get_summary_ctx(message, state)
+    if ctx is None:
+        return
+    await state.clear()
+    await message.answer("❌ Cancelled.")
+    await complete_line(ctx[0], add_score=False)
+
+
+# Commands for ADMIN
+ADMIN_COMMANDS = [
+    BotCommand(command="start", description="Start the bot"),
+    BotCommand(command="line", description="Request a new line"),
+    BotCommand(command="leaderboard", description="🏆 View Top Agents"),
+    BotCommand(command="resetleaderboard", description="reset leaderboard (makes score to 0)"),
+    BotCommand(command="add", description="Add numbers manually"),
+    BotCommand(command="done", description="Confirm numbers addition"),
+    BotCommand(command="upload", description="Upload CSV/TXT file"),
+    BotCommand(command="addadmin", description="Add new admin (Master only)"),
+    BotCommand(command="removeadmin", description="Remove admin (Master only)"),
+    BotCommand(command="listadmins", description="List all admins"),
+    BotCommand(command="stats", description="View queue statistics"),
+    BotCommand(command="reset", description="Reset all numbers"),
+    BotCommand(command="clear", description="Delete all numbers"),
+    BotCommand(command="clearrequests", description="Clear pending requests"),
+    BotCommand(command="export_used", description="Export used numbers"),
+    BotCommand(command="export_unused", description="Export unused numbers"),
+    BotCommand(command="export_all", description="Export all data"),
+    BotCommand(command="export_no_answer", description="Export no answer records"),
+    BotCommand(command="export_callbacks", description="Export callback records"),
+    BotCommand(command="stop", description="Stop the bot"),
+]
+
+# Commands for REGULAR USERS
+USER_COMMANDS = [
+    BotCommand(command="start", description="Start the bot"),
+    BotCommand(command="leaderboard", description="🏆 View Top Agents"),
+]
 
-    # Set commands for all other admins
+
+async def set_bot_commands(bot: Bot):
+    """Set up bot command menus for different user types"""
     try:
-        admins = get_all_admins()
-        for admin in admins:
-            if admin['user_id'] != ADMIN_ID:
-                try:
-                    await bot.set_my_commands(
-                        admin_commands,
-                        scope=BotCommandScopeChat(chat_id=admin['user_id'])
-                    )
-                except Exception as e:
-                    logging.error(f"Failed to set commands for admin {admin['user_id']}: {e}")
+        admins = await run_db(get_all_admins)
     except Exception as e:
         logging.error(f"Error getting admins: {e}")
+        admins = []
 
-    # Set default commands for everyone else
-    await bot.set_my_commands(user_commands)
+    admin_ids = [ADMIN_ID] + [admin['user_id'] for admin in admins if admin['user_id'] != ADMIN_ID]
+
+    # Each scope is a separate Bot API call; issue them concurrently
+    results = await asyncio.gather(
+        *(bot.set_my_commands(ADMIN_COMMANDS, scope=BotCommandScopeChat(chat_id=admin_id))
+          for admin_id in admin_ids),
+        bot.set_my_commands(USER_COMMANDS),
+        return_exceptions=True
+    )
+    for admin_id, result in zip(admin_ids, results):
+        if isinstance(result, Exception):
+            logging.error(f"Failed to set commands for admin {admin_id}: {result}")
+    if isinstance(results[-1], Exception):
+        logging.error(f"Failed to set default commands: {results[-1]}")
 
     logging.info("✅ Bot commands set!")
 
@@ -873,8 +1536,7 @@ async def set_bot_commands(bot: Bot):
 @router.message(Command("listadmins"), F.from_user.id == ADMIN_ID)
 async def cmd_list_admins(message: Message):
     """List all admins"""
-    loop = asyncio.get_event_loop()
-    admins = await loop.run_in_executor(None, get_all_admins)
+    admins = await run_db(get_all_admins)
 
     text = "<b>👑 Admin List</b>\n\n"
     text += f"<b>Master Admin:</b>\n• ID: <code>{ADMIN_ID}</code>\n\n"
@@ -892,8 +1554,7 @@ async def cmd_list_admins(message: Message):
 
 @router.message(Command("resetleaderboard"), F.from_user.id == ADMIN_ID)
 async def cmd_reset_leaderboard(message: Message):
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, reset_scores)
+    await run_db(reset_scores)
     await message.answer("🔄 <b>Leaderboard has been reset!</b> All scores are 0.", parse_mode="HTML")
 
 
@@ -910,47 +1571,17 @@ async def cmd_add_admin(message: Message, state: FSMContext, bot: Bot):
             await message.answer("❌ This user is already the master admin.")
             return
 
-        loop = asyncio.get_event_loop()
-
-        # Check if already admin
-        if await loop.run_in_executor(None, is_admin, new_admin_id):
-            await message.answer(f"ℹ️ {new_admin_username} is already an admin.")
-            return
-
-        # Add the admin
+        # Add the admin (no-op if they already are one)
         try:
-            await loop.run_in_executor(None, add_admin, new_admin_id, new_admin_username, ADMIN_ID)
+            if not await run_db(add_admin, new_admin_id, new_admin_username, ADMIN_ID):
+                await message.answer(f"ℹ️ {new_admin_username} is already an admin.")
+                return
 
             # Set admin commands for the new admin
-            from aiogram.types import BotCommandScopeChat
-            admin_commands = [
-                BotCommand(command="start", description="Start the bot"),
-                BotCommand(command="line", description="Request a new line"),
-                BotCommand(command="add", description="Add numbers manually"),
-                BotCommand(command="done", description="Confirm numbers addition"),
-                BotCommand(command="upload", description="Upload CSV/TXT file"),
-                BotCommand(command="addadmin", description="Add new admin (Master only)"),
-                BotCommand(command="removeadmin", description="Remove admin (Master only)"),
-                BotCommand(command="listadmins", description="List all admins"),
-                BotCommand(command="stats", description="View queue statistics"),
-                BotCommand(command="reset", description="Reset all numbers"),
-                BotCommand(command="clear", description="Delete all numbers"),
-                BotCommand(command="clearrequests", description="Clear pending requests"),
-                BotCommand(command="export_used", description="Export used numbers"),
-                BotCommand(command="export_unused", description="Export unused numbers"),
-                BotCommand(command="export_all", description="Export all data"),
-                BotCommand(command="export_no_answer", description="Export no answer records"),
-                BotCommand(command="export_callbacks", description="Export callback records"),
-                BotCommand(command="stop", description="Stop the bot"),
-            ]
-
-            try:
-                await bot.set_my_commands(
-                    admin_commands,
-                    scope=BotCommandScopeChat(chat_id=new_admin_id)
-                )
-            except:
-                pass
+            await best_effort(
+                f"Setting admin commands for {new_admin_id}",
+                bot.set_my_commands, ADMIN_COMMANDS, scope=BotCommandScopeChat(chat_id=new_admin_id)
+            )
 
             await message.answer(
                 f"✅ <b>Admin Added!</b>\n\n"
@@ -961,14 +1592,13 @@ async def cmd_add_admin(message: Message, state: FSMContext, bot: Bot):
             )
 
             # Notify the new admin
-            try:
-                await bot.send_message(
-                    chat_id=new_admin_id,
-                    text="🎉 You've been promoted to admin! You can now approve line requests.",
-                    parse_mode=ParseMode.HTML
-                )
-            except:
-                pass
+            await best_effort(
+                f"Notifying new admin {new_admin_id}",
+                bot.send_message,
+                chat_id=new_admin_id,
+                text="🎉 You've been promoted to admin! You can now approve line requests.",
+                parse_mode=ParseMode.HTML
+            )
 
         except Exception as e:
             await message.answer(f"❌ Error adding admin: {e}")
@@ -999,17 +1629,12 @@ async def receive_forward_add_admin(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    loop = asyncio.get_event_loop()
-
-    # Check if already admin
-    if await loop.run_in_executor(None, is_admin, new_admin_id):
-        await message.answer(f"ℹ️ {new_admin_username} is already an admin.")
-        await state.clear()
-        return
-
-    # Add the admin
+    # Add the admin (no-op if they already are one)
     try:
-        await loop.run_in_executor(None, add_admin, new_admin_id, new_admin_username, ADMIN_ID)
+        if not await run_db(add_admin, new_admin_id, new_admin_username, ADMIN_ID):
+            await message.answer(f"ℹ️ {new_admin_username} is already an admin.")
+            await state.clear()
+            return
         await message.answer(
             f"✅ <b>Admin Added!</b>\n\n"
             f"User: {new_admin_username}\n"
@@ -1019,14 +1644,13 @@ async def receive_forward_add_admin(message: Message, state: FSMContext):
         )
 
         # Notify the new admin
-        try:
-            await message.bot.send_message(
-                chat_id=new_admin_id,
-                text="🎉 You've been promoted to admin! You can now approve line requests.",
-                parse_mode=ParseMode.HTML
-            )
-        except:
-            pass
+        await best_effort(
+            f"Notifying new admin {new_admin_id}",
+            message.bot.send_message,
+            chat_id=new_admin_id,
+            text="🎉 You've been promoted to admin! You can now approve line requests.",
+            parse_mode=ParseMode.HTML
+        )
 
     except Exception as e:
         await message.answer(f"❌ Error adding admin: {e}")
@@ -1036,12 +1660,11 @@ async def receive_forward_add_admin(message: Message, state: FSMContext):
 
 @router.message(Command("leaderboard"))
 async def cmd_leaderboard(message: Message, bot: Bot):  # <--- Added bot argument
-    loop = asyncio.get_event_loop()
 
     await message.answer("🎨 Fetching profiles & generating leaderboard...")
 
     # 1. Fetch DB Data
-    leaders = await loop.run_in_executor(None, get_leaderboard_data)
+    leaders = await run_db(get_leaderboard_data)
 
     if not leaders:
         await message.answer("📉 No scores yet!")
@@ -1062,7 +1685,9 @@ async def cmd_leaderboard(message: Message, bot: Bot):  # <--- Added bot argumen
         leaders[idx]['avatar_obj'] = img_obj
 
     # 3. Generate Image (Sync Executor)
-    image_bio = await loop.run_in_executor(None, generate_leaderboard_image, leaders)
+    image_bio = await asyncio.get_running_loop().run_in_executor(
+        RENDER_EXECUTOR, generate_leaderboard_image, leaders
+    )
 
     # 4. Send
     photo = BufferedInputFile(image_bio.getvalue(), filename="leaderboard.png")
@@ -1071,11 +1696,6 @@ async def cmd_leaderboard(message: Message, bot: Bot):  # <--- Added bot argumen
 @router.message(AdminStates.waiting_for_forward, ~F.forward_from)
 async def receive_non_forward_add_admin(message: Message, state: FSMContext):
     """Handle non-forwarded message during add admin flow"""
-    if message.text and message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Cancelled.")
-        return
-
     await message.answer(
         "❌ Please forward a message from the user.\n\n"
         "The message must show 'Forwarded from [username]' at the top.\n\n"
@@ -1096,23 +1716,14 @@ async def cmd_remove_admin(message: Message, state: FSMContext, bot: Bot):
             await message.answer("❌ Cannot remove master admin.")
             return
 
-        loop = asyncio.get_event_loop()
-        count = await loop.run_in_executor(None, remove_admin, admin_to_remove)
+        count = await run_db(remove_admin, admin_to_remove)
 
         if count > 0:
             # Reset to user commands for removed admin
-            from aiogram.types import BotCommandScopeChat
-            user_commands = [
-                BotCommand(command="start", description="Start the bot"),
-            ]
-
-            try:
-                await bot.set_my_commands(
-                    user_commands,
-                    scope=BotCommandScopeChat(chat_id=admin_to_remove)
-                )
-            except:
-                pass
+            await best_effort(
+                f"Resetting commands for {admin_to_remove}",
+                bot.set_my_commands, USER_COMMANDS, scope=BotCommandScopeChat(chat_id=admin_to_remove)
+            )
 
             await message.answer(
                 f"✅ <b>Admin Removed!</b>\n\n"
@@ -1123,14 +1734,13 @@ async def cmd_remove_admin(message: Message, state: FSMContext, bot: Bot):
             )
 
             # Notify the removed admin
-            try:
-                await bot.send_message(
-                    chat_id=admin_to_remove,
-                    text="ℹ️ Your admin privileges have been removed.",
-                    parse_mode=ParseMode.HTML
-                )
-            except:
-                pass
+            await best_effort(
+                f"Notifying removed admin {admin_to_remove}",
+                bot.send_message,
+                chat_id=admin_to_remove,
+                text="ℹ️ Your admin privileges have been removed.",
+                parse_mode=ParseMode.HTML
+            )
         else:
             await message.answer(f"❌ {admin_username} is not an admin.")
 
@@ -1160,8 +1770,7 @@ async def receive_forward_remove_admin(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    loop = asyncio.get_event_loop()
-    count = await loop.run_in_executor(None, remove_admin, admin_to_remove)
+    count = await run_db(remove_admin, admin_to_remove)
 
     if count > 0:
         await message.answer(
@@ -1173,14 +1782,13 @@ async def receive_forward_remove_admin(message: Message, state: FSMContext):
         )
 
         # Notify the removed admin
-        try:
-            await message.bot.send_message(
-                chat_id=admin_to_remove,
-                text="ℹ️ Your admin privileges have been removed.",
-                parse_mode=ParseMode.HTML
-            )
-        except:
-            pass
+        await best_effort(
+            f"Notifying removed admin {admin_to_remove}",
+            message.bot.send_message,
+            chat_id=admin_to_remove,
+            text="ℹ️ Your admin privileges have been removed.",
+            parse_mode=ParseMode.HTML
+        )
     else:
         await message.answer(f"❌ {admin_username} is not an admin.")
 
@@ -1190,11 +1798,6 @@ async def receive_forward_remove_admin(message: Message, state: FSMContext):
 @router.message(AdminStates.waiting_for_remove_forward, ~F.forward_from)
 async def receive_non_forward_remove_admin(message: Message, state: FSMContext):
     """Handle non-forwarded message during remove admin flow"""
-    if message.text and message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Cancelled.")
-        return
-
     await message.answer(
         "❌ Please forward a message from the user.\n\n"
         "The message must show 'Forwarded from [username]' at the top.\n\n"
@@ -1206,10 +1809,9 @@ async def receive_non_forward_remove_admin(message: Message, state: FSMContext):
 async def cmd_start(message: Message, state: FSMContext):
     if message.chat.type == "private":
         if message.from_user.id == ADMIN_ID:
-            status = get_bot_status()
+            status = await run_db(get_bot_status)
             if status == "stopped":
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(None, set_bot_status, "running")
+                await run_db(set_bot_status, "running")
                 await message.answer("▶️ <b>Bot restarted!</b>\n\nUsers can now request lines.", parse_mode="HTML")
             else:
                 await message.answer(
@@ -1228,35 +1830,29 @@ async def cmd_start(message: Message, state: FSMContext):
                 )
         else:
             try:
-                print(message.from_user)
-                member = await message.bot.get_chat_member(GROUP_CHAT_ID, message.from_user.id)
-                print(member.status)
-                if member.status == "kicked":
+                member_status = await get_member_status(message.bot, message.from_user.id)
+                if member_status == "kicked":
                     await message.answer("⚠️ You're blocked from the group!")
                     return
-                if member.status == 'left':
+                if member_status == 'left':
                     await message.answer("⚠️ You must be a member of the group!")
                     return
-            except Exception as e:
-                print(traceback.format_exc())
+            except Exception:
+                logging.exception(f"Membership check for {message.from_user.id} failed")
                 await message.answer("⚠️ You must be a member of the group!")
                 return
 
             # Check if user already has agent name
-            loop = asyncio.get_event_loop()
-            user_info = await loop.run_in_executor(None, get_user_info, message.from_user.id)
+            user_info = await run_db(get_user_info, message.from_user.id)
 
             if user_info and user_info.get('agent_name'):
                 # User already set agent name - show line button
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="Line 📞", callback_data="request_line")]
-                ])
                 await message.answer(
                     f"👋 Welcome back, <b>{user_info['agent_name']}</b>!\n\n"
                     f"🗃️ Reference: <code>{user_info['reference']}</code>\n\n"
                     "Press the button below to request a line",
                     parse_mode="HTML",
-                    reply_markup=keyboard
+                    reply_markup=LINE_KB
                 )
             else:
                 # First time user - ask for agent name
@@ -1273,11 +1869,6 @@ async def cmd_start(message: Message, state: FSMContext):
 # FIND THIS HANDLER AND UPDATE THE LOGIC
 @router.message(UserStates.waiting_for_agent_name, F.text)
 async def receive_agent_name(message: Message, state: FSMContext):
-    if message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Cancelled.")
-        return
-
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     agent_name = message.text.strip()
@@ -1286,12 +1877,7 @@ async def receive_agent_name(message: Message, state: FSMContext):
         await message.answer("❌ Agent name must be 2-50 characters!")
         return
 
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, save_agent_name, user_id, agent_name, username)
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Line 📞", callback_data="request_line")]
-    ])
+    await run_db(save_agent_name, user_id, agent_name, username)
 
     await message.answer(
         f"✅ <b>Agent name saved!</b>\n\n"
@@ -1299,7 +1885,7 @@ async def receive_agent_name(message: Message, state: FSMContext):
         f"🗃️ Reference: <code>CB2061</code>\n\n"
         "Press the button below to request a line",
         parse_mode="HTML",
-        reply_markup=keyboard
+        reply_markup=LINE_KB
     )
 
     await state.clear()
@@ -1308,42 +1894,41 @@ async def receive_agent_name(message: Message, state: FSMContext):
 # Add this to your database functions
 def set_bot_status(status: str):
     """Set bot status (running/stopped)"""
+    # bot_status is created by init_database at startup
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(
-                """CREATE TABLE IF NOT EXISTS bot_status (
-                   id INT PRIMARY KEY DEFAULT 1,
-                   status VARCHAR(50) DEFAULT 'running'
-                )"""
-            )
             cursor.execute(
                 "INSERT INTO bot_status (id, status) VALUES (1, %s) ON DUPLICATE KEY UPDATE status = %s",
                 (status, status)
             )
+    _status_cache.set('status', status)
 
 
 def get_bot_status():
     """Get bot status"""
+    status = _status_cache.get('status')
+    if status is not None:
+        return status
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("SELECT status FROM bot_status WHERE id = 1")
             result = cursor.fetchone()
-            return result['status'] if result else 'running'
+    status = result['status'] if result else 'running'
+    _status_cache.set('status', status)
+    return status
 
 
 # Add these commands to your router
 @router.message(Command("stop"), F.from_user.id == ADMIN_ID)
 async def cmd_stop(message: Message):
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, set_bot_status, "stopped")
+    await run_db(set_bot_status, "stopped")
     await message.answer("⏸️ <b>Bot stopped!</b>\n\nUsers can't request lines now.", parse_mode="HTML")
 
 
 @router.message(Command("clearrequests"), F.from_user.id == ADMIN_ID)
 async def cmd_clear_requests(message: Message):
     """Clear all pending line requests"""
-    loop = asyncio.get_event_loop()
-    deleted_count = await loop.run_in_executor(None, clear_pending_requests)
+    deleted_count = await run_db(clear_pending_requests)
 
     await message.answer(
         f"<b>Pending Requests Cleared</b>\n"
@@ -1361,38 +1946,14 @@ async def cmd_line(message: Message, bot: Bot):
 
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
-    user_mention = message.from_user.mention_html()
-
-    loop = asyncio.get_event_loop()
+    user_mention = mention_html(message.from_user)
 
-    # CHECK: Does user already have a line assigned?
-    existing_record = await loop.run_in_executor(None, get_user_record, user_id)
-
-    if existing_record and existing_record.get('is_used'):
-        await message.reply(
-            f"⚠️ {user_mention}, you already have a line assigned!\n\n"
-            "Once you're done, you can request another line.",
-            parse_mode="HTML"
-        )
+    if not await check_line_eligibility(bot, user_id, message.reply):
         return
 
-    # Create new line request
-    request_id = await loop.run_in_executor(None, create_line_request, user_id, username)
-
-    # Notify admin
-    admin_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Approve", callback_data=f"approve_line_{request_id}"),
-            InlineKeyboardButton(text="❌ Decline", callback_data=f"decline_line_{request_id}")
-        ]
-    ])
-
-    await bot.send_message(
-        chat_id=ADMIN_ID,
-        text=f"🔔 <b>New Line Request</b>\n\n👤 <b>User:</b> {username} (ID: {user_id})",
-        parse_mode="HTML",
-        reply_markup=admin_keyboard
-    )
+    # Create new line request and put it in front of every admin
+    request_id = await run_db(create_line_request, user_id, username)
+    await send_request_to_all_admins(bot, request_id, user_mention, username)
 
     # Notify group
     await message.reply(f"📝 {user_mention} has requested a new line", parse_mode="HTML")
@@ -1408,7 +1969,12 @@ async def new_member_welcome(message: Message):
         if new_member.is_bot:
             continue
 
-        user_mention = new_member.mention_html()
+        # chat_member updates only arrive while the bot is a group admin, so don't let
+        # a cached "left" outlive the join
+        if message.chat.id == GROUP_CHAT_ID:
+            _member_cache.set(new_member.id, "member")
+
+        user_mention = mention_html(new_member)
 
         await message.answer(
             f"👋 {user_mention} welcome to the group chat, message me in private to start",
@@ -1416,6 +1982,12 @@ async def new_member_welcome(message: Message):
         )
 
 
+@router.message(F.left_chat_member, F.chat.id == GROUP_CHAT_ID)
+async def member_left(message: Message):
+    # Drop the entry so the next line request asks Telegram (left vs kicked)
+    _member_cache.pop(message.left_chat_member.id)
+
+
 # Upload CSV file
 @router.message(Command("upload"), F.chat.type == "private", F.from_user.id == ADMIN_ID)
 async def cmd_upload(message: Message, state: FSMContext):
@@ -1428,29 +2000,102 @@ async def cmd_upload(message: Message, state: FSMContext):
     await state.set_state(AdminStates.waiting_for_file)
 
 
+# Header keywords per field, checked in this order; a column is claimed by the first
+# field whose pattern matches it
+COLUMN_PATTERNS = (
+    ('number', re.compile(r'number|phone|tel', re.I)),
+    ('name', re.compile(r'name|full', re.I)),
+    ('address', re.compile(r'addr|location', re.I)),
+    ('email', re.compile(r'mail', re.I)),
+)
+
+
 def detect_column_mapping(header_row):
     """Auto-detect which column is which"""
     mapping = {'number': None, 'name': None, 'address': None, 'email': None}
 
     for idx, col in enumerate(header_row):
-        col_lower = col.lower().strip()
-
-        # Detect number column
-        if 'number' in col_lower or 'phone' in col_lower or 'tel' in col_lower:
-            mapping['number'] = idx
-        # Detect name column
-        elif 'name' in col_lower or 'full' in col_lower or 'fname' in col_lower:
-            mapping['name'] = idx
-        # Detect address column
-        elif 'address' in col_lower or 'location' in col_lower or 'addr' in col_lower:
-            mapping['address'] = idx
-        # Detect email column
-        elif 'email' in col_lower or 'mail' in col_lower or 'e-mail' in col_lower:
-            mapping['email'] = idx
+        for field, pattern in COLUMN_PATTERNS:
+            if pattern.search(col):
+                mapping[field] = idx
+                break
 
     return mapping
 
 
+CSV_FIELDS = ('number', 'name', 'address', 'email')
+
+
+def iter_csv_records(rows, mapping):
+    """Yield (number, name, address, email) tuples from csv rows using the detected mapping"""
+    width = max(idx for idx in mapping.values() if idx is not None) + 1
+    # Short rows are padded so every lookup is a single C-level itemgetter call;
+    # columns that weren't detected read from the padding and come back empty
+    pick = itemgetter(*(mapping[field] if mapping[field] is not None else width for field in CSV_FIELDS))
+    padding = [''] * (width + 1)
+
+    for row in rows:
+        if len(row) < 2:  # Skip empty rows
+            continue
+        number, name, address, email = pick(row + padding)
+        number, name = number.strip(), name.strip()
+        # USER RULE: Only import if number and name exist
+        if number and name:
+            yield number, name, address.strip() or None, email.strip() or None
+
+
+UPLOAD_BATCH_SIZE = 1000
+
+
+def import_csv_upload(file_content):
+    """Parse an uploaded CSV buffer and insert it in batches; returns (imported, mapping, error)
+
+    Runs on the DB executor so decoding/parsing a large file never blocks the event loop.
+    Rows are streamed straight off the download buffer, so the upload never sits in
+    memory as one decoded string + record list. Batches are committed as they go, so a
+    decode/CSV error part way through leaves the earlier rows imported; `error` then says
+    where parsing stopped (None if the whole file went in).
+    """
+    imported = 0
+    mapping = None
+    error = None
+    csv_reader = None
+
+    try:
+        text_stream = io.TextIOWrapper(file_content, encoding='utf-8', newline='')
+        try:
+            # Parse as CSV with proper quote handling
+            csv_reader = csv.reader(text_stream)
+
+            # Read header and detect columns
+            header = next(csv_reader, None)
+            if header:
+                mapping = detect_column_mapping(header)
+                if mapping['number'] is not None:
+                    records = iter_csv_records(csv_reader, mapping)
+                    while batch := list(islice(records, UPLOAD_BATCH_SIZE)):
+                        add_records_from_csv(batch)
+                        imported += len(batch)
+        finally:
+            # Leave the underlying buffer open for the fallback parser
+            text_stream.detach()
+    except Exception as e:
+        line = csv_reader.line_num if csv_reader is not None else 0
+        error = f"line {line}: {e}"
+        logging.warning(f"CSV Parse failed at {error}")
+
+    return imported, mapping, error
+
+
+def parse_mixed_upload(file_content):
+    """Decode an uploaded buffer and run the key-value parser over it (executor side)"""
+    file_content.seek(0)
+    content = file_content.read().decode('utf-8')
+    mixed_records = parse_mixed_formats(content)
+    # Filter: Only keep records with name
+    return [r for r in mixed_records if r[1] and r[1].strip()]
+
+
 @router.message(AdminStates.waiting_for_file, F.document)
 async def handle_file_upload(message: Message, state: FSMContext, bot: Bot):
     document = message.document
@@ -1463,58 +2108,24 @@ async def handle_file_upload(message: Message, state: FSMContext, bot: Bot):
         file = await bot.get_file(document.file_id)
         file_content = await bot.download_file(file.file_path)
 
-        content = file_content.read().decode('utf-8')
-        
         # 1. Try Standard CSV Parser FIRST
         # This prevents Mixed Parser from hijacking valid CSVs that happen to contain keywords in cells
-        csv_records = []
-        is_valid_csv = False
-        
-        try:
-            # Parse as CSV with proper quote handling
-            csv_file = io.StringIO(content)
-            csv_reader = csv.reader(csv_file)
-            
-            # Read header and detect columns
-            header = next(csv_reader, None)
-            if header:
-                mapping = detect_column_mapping(header)
-                if mapping['number'] is not None:
-                    is_valid_csv = True
-                    for row in csv_reader:
-                        if len(row) < 2:  # Skip empty rows
-                            continue
-
-                        # Extract based on detected mapping
-                        number = row[mapping['number']].strip() if mapping['number'] is not None else None
-                        
-                        # Fix index out of bounds if row is shorter than mapping detected in header
-                        name_idx = mapping['name']
-                        name = row[name_idx].strip() if name_idx is not None and len(row) > name_idx else None
-                        
-                        addr_idx = mapping['address']
-                        address = row[addr_idx].strip() if addr_idx is not None and len(row) > addr_idx else None
-                        
-                        email_idx = mapping['email']
-                        email = row[email_idx].strip() if email_idx is not None and len(row) > email_idx else None
-
-                        if number:  # Only add if number exists
-                             # USER RULE: Only import if name exists
-                            if not name:
-                                continue
-                            csv_records.append((number, name, address, email))
-        except Exception as e:
-            logging.warning(f"CSV Parse failed: {e}")
-            
-        if is_valid_csv and csv_records:
-             loop = asyncio.get_event_loop()
-             await loop.run_in_executor(None, add_records_from_csv, csv_records)
+        imported, mapping, error = await run_db(import_csv_upload, file_content)
 
+        if imported:
              # Show detected mapping
              cols_found = [f"{k.title()}: Col {v + 1}" for k, v in mapping.items() if v is not None]
+             if error:
+                 # Earlier batches are already committed; say exactly where it stopped
+                 header = (
+                     f"⚠️ <b>Partial import: {imported} records imported</b>\n\n"
+                     f"Stopped at {html_decoration.quote(error)}\n"
+                     "Rows from that point on were not imported.\n\n"
+                 )
+             else:
+                 header = f"✅ <b>Imported {imported} records!</b>\n\n"
              await message.answer(
-                 f"✅ <b>Imported {len(csv_records)} records!</b>\n\n"
-                 f"📋 Detected columns:\n• " + "\n• ".join(cols_found),
+                 header + f"📋 Detected columns:\n• " + "\n• ".join(cols_found),
                  parse_mode="HTML"
              )
              await state.clear()
@@ -1524,13 +2135,10 @@ async def handle_file_upload(message: Message, state: FSMContext, bot: Bot):
         # 2. Key-Value Mixed Format Parser (Fallback for Bk fullz etc)
         # Only reached if CSV failed or found nothing relevant
         try:
-            mixed_records = parse_mixed_formats(content)
-            # Filter: Only keep records with name
-            mixed_records = [r for r in mixed_records if r[1] and r[1].strip()]
-            
+            mixed_records = await run_db(parse_mixed_upload, file_content)
+
             if mixed_records:
-                 loop = asyncio.get_event_loop()
-                 await loop.run_in_executor(None, add_records_from_csv, mixed_records)
+                 await run_db(add_records_from_csv, mixed_records)
                  
                  await message.answer(
                      f"✅ <b>Imported {len(mixed_records)} records (Mixed Format)!</b>", 
@@ -1556,28 +2164,20 @@ async def cancel_upload(message: Message, state: FSMContext):
     await message.answer("❌ Upload cancelled.")
 
 
-# Add numbers command
-def detect_column_mapping_text(header_row):
-    """Auto-detect which column is which"""
-    mapping = {'number': None, 'name': None, 'address': None, 'email': None}
+# Records parsed during /add, keyed by admin user_id. Kept out of FSM storage so
+# each message appends in place instead of copying the whole list back into state
+_pending_numbers = {}
 
-    for idx, col in enumerate(header_row):
-        col_lower = col.lower().strip()
 
-        if 'number' in col_lower or 'phone' in col_lower or 'tel' in col_lower:
-            mapping['number'] = idx
-        elif 'name' in col_lower or 'full' in col_lower or 'fname' in col_lower:
-            mapping['name'] = idx
-        elif 'address' in col_lower or 'location' in col_lower or 'addr' in col_lower:
-            mapping['address'] = idx
-        elif 'email' in col_lower or 'mail' in col_lower or 'e-mail' in col_lower:
-            mapping['email'] = idx
-
-    return mapping
+async def clear_adding(state: FSMContext, user_id: int):
+    """Leave the /add flow and drop any buffered records"""
+    _pending_numbers.pop(user_id, None)
+    await state.clear()
 
 
 @router.message(Command("add"), F.chat.type == "private", F.from_user.id == ADMIN_ID )
 async def cmd_add(message: Message, state: FSMContext):
+    _pending_numbers.pop(message.from_user.id, None)
     await message.answer(
         "📝 Send data in CSV format (Number,Name,Address,Email) or just numbers.\n"
         "Auto-detects column order!\n\n"
@@ -1589,18 +2189,17 @@ async def cmd_add(message: Message, state: FSMContext):
 
 @router.message(AdminStates.waiting_for_numbers, Command("cancel"))
 async def cancel_adding(message: Message, state: FSMContext):
-    await state.clear()
+    await clear_adding(state, message.from_user.id)
     await message.answer("❌ Cancelled.")
 
 
 @router.message(AdminStates.waiting_for_numbers, Command("done"))
 async def finish_adding(message: Message, state: FSMContext):
     data = await state.get_data()
-    numbers = data.get('numbers', [])
+    numbers = _pending_numbers.get(message.from_user.id, [])
 
     if numbers:
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, add_records_from_csv, numbers)
+        await run_db(add_records_from_csv, numbers)
 
         # Show summary
         mapping = data.get('mapping', {})
@@ -1614,11 +2213,7 @@ async def finish_adding(message: Message, state: FSMContext):
     else:
         await message.answer("No records added.")
 
-    await state.clear()
-
-
-    await state.update_data(numbers=numbers, mapping=mapping)
-    await message.answer(f"✅ Parsed {len(numbers)} records correctly!")
+    await clear_adding(state, message.from_user.id)
 
 
 
@@ -1842,41 +2437,11 @@ def parse_mixed_formats(text):
 
 
 
-@router.message(AdminStates.waiting_for_numbers)
-async def receive_numbers(message: Message, state: FSMContext, bot: Bot):
-    
-    # Handle File Upload Redirection if user sends file here
-    if message.document:
-        await handle_file_upload(message, state, bot)
-        return
-
-    data = await state.get_data()
-    numbers = data.get('numbers', [])
-    text = message.text
-    
-    if not text:
-         await message.answer("⚠️ Please send text or a valid text/csv file.")
-         return
-    
-    # 1. Try generic mixed format parser
-    # It catches almost anything with "Phone:" or "Mobile:" labels
-    try:
-        mixed_records = parse_mixed_formats(text)
-        if mixed_records:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, add_records_from_csv, mixed_records)
-            await message.answer(f"✅ <b>Parsed & Added {len(mixed_records)} records (Mixed Format)!</b>", parse_mode="HTML")
-            await state.clear()
-            return
-    except Exception as e:
-        logging.error(f"Mixed parse error: {e}")
-        # Don't return, fall through to CSV parser just in case
-    
-    # 2. Fallback to existing CSV parser
-    # ... (CSV logic) ...
-
+def parse_numbers_text(text):
+    """Parse a pasted CSV chunk from /add; returns (records, mapping)"""
     # Parse as CSV with proper quote handling
-    csv_reader = csv.reader(io.StringIO(message.text))
+    csv_reader = csv.reader(io.StringIO(text))
+    records = []
 
     first_row = True
     mapping = None
@@ -1892,7 +2457,7 @@ async def receive_numbers(message: Message, state: FSMContext, bot: Bot):
                             ['number', 'phone', 'tel', 'name', 'address', 'email', 'mail'])
 
             if is_header:
-                mapping = detect_column_mapping_text(row)
+                mapping = detect_column_mapping(row)
                 first_row = False
                 continue
             else:
@@ -1909,17 +2474,57 @@ async def receive_numbers(message: Message, state: FSMContext, bot: Bot):
         email = row[mapping['email']].strip() if mapping['email'] is not None and len(row) > mapping['email'] else None
 
         if number:  # Only add if number exists
-            numbers.append((number, name, address, email))
+            records.append((number, name, address, email))
+
+    return records, mapping
+
+
+@router.message(AdminStates.waiting_for_numbers)
+async def receive_numbers(message: Message, state: FSMContext, bot: Bot):
+    
+    # Handle File Upload Redirection if user sends file here
+    if message.document:
+        await handle_file_upload(message, state, bot)
+        return
+
+    text = message.text
+    
+    if not text:
+         await message.answer("⚠️ Please send text or a valid text/csv file.")
+         return
+    
+    # 1. Try generic mixed format parser
+    # It catches almost anything with "Phone:" or "Mobile:" labels
+    try:
+        mixed_records = await run_db(parse_mixed_formats, text)
+        if mixed_records:
+            await run_db(add_records_from_csv, mixed_records)
+            await message.answer(f"✅ <b>Parsed & Added {len(mixed_records)} records (Mixed Format)!</b>", parse_mode="HTML")
+            await clear_adding(state, message.from_user.id)
+            return
+    except Exception as e:
+        logging.error(f"Mixed parse error: {e}")
+        # Don't return, fall through to CSV parser just in case
+    
+    # 2. Fallback to existing CSV parser
+    # ... (CSV logic) ...
+
+    # Parse off the event loop; a large paste is thousands of rows
+    records, mapping = await run_db(parse_numbers_text, text)
+    numbers = _pending_numbers.setdefault(message.from_user.id, [])
+    if not numbers:
+        # FSM state only carries the mapping shown at /done; write it once per /add
+        # session rather than on every pasted chunk
+        await state.update_data(mapping=mapping)
+    numbers.extend(records)
 
-    await state.update_data(numbers=numbers, mapping=mapping)
     await message.answer(f"✅ Parsed {len(numbers)} CSV records correctly!")
 
 
 # Stats command
 @router.message(Command("stats"), F.from_user.id == ADMIN_ID)
 async def cmd_stats(message: Message):
-    loop = asyncio.get_event_loop()
-    remaining, used = await loop.run_in_executor(None, get_queue_stats)
+    remaining, used = await run_db(get_queue_stats)
     await message.answer(
         f"📊 <b>Queue Stats:</b>\n\n"
         f"Remaining: {remaining}\n"
@@ -1932,111 +2537,173 @@ async def cmd_stats(message: Message):
 # Reset queue
 @router.message(Command("reset"), F.chat.type == "private", F.from_user.id == ADMIN_ID)
 async def cmd_reset(message: Message):
-    loop = asyncio.get_event_loop()
-    count = await loop.run_in_executor(None, reset_queue)
+    count = await run_db(reset_queue)
     await message.answer(f"🔄 Reset {count} numbers.")
 
 
 # Clear queue
 @router.message(Command("clear"), F.chat.type == "private", F.from_user.id == ADMIN_ID)
 async def cmd_clear(message: Message):
-    loop = asyncio.get_event_loop()
-    count = await loop.run_in_executor(None, clear_queue)
+    count = await run_db(clear_queue)
     await message.answer(f"🗑️ Deleted {count} numbers.")
 
 
 # Export commands
 @router.message(Command("export_used"), F.from_user.id == ADMIN_ID)
 async def cmd_export_used(message: Message):
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, export_used_numbers)
-
-    if result[0]:
-        csv_content, deleted_count = result
-        file_bytes = csv_content.encode('utf-8')
-        file = BufferedInputFile(file_bytes, filename="used_numbers.csv")
-        await message.answer_document(file, caption=f"📊 Report\n✅ {deleted_count} deleted")
-    else:
-        await message.answer("No used numbers found.")
+    if _export_used_lock.locked():
+        await message.answer("⏳ The previous export is still being purged, try again in a moment.")
+        return
+    await _export_used_lock.acquire()
+
+    purge_scheduled = False
+    try:
+        with export_tempfile() as path:
+            exported, max_id = await run_db(export_used_numbers, path)
+
+            if exported:
+                file = FSInputFile(path, filename="used_numbers.csv")
+                await message.answer_document(file, caption=f"📊 Report\n✅ {exported} exported, purge scheduled")
+                # The purge task releases the lock when it's done
+                spawn_background(purge_completed_lines(max_id))
+                purge_scheduled = True
+            else:
+                await message.answer("No used numbers found.")
+    finally:
+        if not purge_scheduled:
+            _export_used_lock.release()
 
 
 @router.message(Command("export_unused"), F.from_user.id == ADMIN_ID)
 async def cmd_export_unused(message: Message):
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, export_unused_numbers)
-
-    if result[0]:
-        csv_content, deleted_count = result
-        file_bytes = csv_content.encode('utf-8')
-        file = BufferedInputFile(file_bytes, filename="unused_numbers.csv")
-        await message.answer_document(file, caption=f"📝 Report\n✅ {deleted_count} deleted")
-    else:
-        await message.answer("No unused numbers found.")
+    with export_tempfile() as path:
+        exported, deleted_count = await run_db(export_unused_numbers, path)
+
+        if exported:
+            file = FSInputFile(path, filename="unused_numbers.csv")
+            await message.answer_document(file, caption=f"📝 Report\n✅ {deleted_count} deleted")
+        else:
+            await message.answer("No unused numbers found.")
 
 
 @router.message(Command("export_all"), F.from_user.id == ADMIN_ID)
 async def cmd_export_all(message: Message):
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, export_all_numbers)
-
-    if result[0]:
-        csv_content, deleted_count = result
-        file_bytes = csv_content.encode('utf-8')
-        file = BufferedInputFile(file_bytes, filename="all_numbers.csv")
-        await message.answer_document(file, caption=f"📋 Report\n✅ {deleted_count} deleted")
-    else:
-        await message.answer("No numbers found.")
+    with export_tempfile() as path:
+        exported, deleted_count = await run_db(export_all_numbers, path)
+
+        if exported:
+            file = FSInputFile(path, filename="all_numbers.csv")
+            await message.answer_document(file, caption=f"📋 Report\n✅ {deleted_count} deleted")
+        else:
+            await message.answer("No numbers found.")
 
 @router.message(Command("export_no_answer"), F.from_user.id == ADMIN_ID)
 async def cmd_export_no_answer(message: Message):
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, export_no_answer_records)
-
-    if result[0]:
-        csv_content, deleted_count = result
-        file_bytes = csv_content.encode('utf-8')
-        file = BufferedInputFile(file_bytes, filename="no_answer_records.csv")
-        await message.answer_document(file, caption=f"❌ No Answer Records\n✅ {deleted_count} records exported")
-    else:
-        await message.answer("No 'No Answer' records found.")
+    with export_tempfile() as path:
+        exported, deleted_count = await run_db(export_no_answer_records, path)
+
+        if exported:
+            file = FSInputFile(path, filename="no_answer_records.csv")
+            await message.answer_document(file, caption=f"❌ No Answer Records\n✅ {deleted_count} records exported")
+        else:
+            await message.answer("No 'No Answer' records found.")
+
+async def broadcast_to_admins(text: str, reply_markup=None):
+    """Queue a message for the master admin and every other admin"""
+    admins = await run_db(get_all_admins)
+    enqueue_message(ADMIN_ID, text, reply_markup=reply_markup, parse_mode="HTML")
+    for admin in admins:
+        if admin['user_id'] != ADMIN_ID:
+            enqueue_message(admin['user_id'], text, reply_markup=reply_markup, parse_mode="HTML")
+
 
 async def send_request_to_all_admins(bot: Bot, request_id: int, user_mention: str, username: str):
     """Send line request to all admins"""
-    loop = asyncio.get_event_loop()
-    admins = await loop.run_in_executor(None, get_all_admins)
+    await broadcast_to_admins(
+        f"📞 <b>Line Request</b>\n\nUser: {user_mention}", reply_markup=approve_decline_kb(request_id)
+    )
+
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+# Keyboards are built once (static) or once per agent (lru_cache) instead of per click
+REQUEST_ANOTHER_LINE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Request Another Line 🔄", callback_data="request_line")]
+])
+
+REQUEST_NEW_LINE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Request New Line 🔄", callback_data="request_line")]
+])
+
+LINE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Line 📞", callback_data="request_line")]
+])
+
+
+def approve_decline_kb(request_id: int):
+    """Approve / Decline buttons for an admin line request"""
+    return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="✅ Approve", callback_data=f"approve_line_{request_id}"),
             InlineKeyboardButton(text="❌ Decline", callback_data=f"decline_line_{request_id}")
         ]
     ])
 
-    # Send to master admin
-    try:
-        await bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f"📞 <b>Line Request</b>\n\nUser: {user_mention}",
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-    except:
-        pass
 
-    # Send to all other admins
-    for admin in admins:
-        if admin['user_id'] != ADMIN_ID:
-            try:
-                print('sending to admin',admin)
-                await bot.send_message(
-                    chat_id=admin['user_id'],
-                    text=f"📞 <b>Line Request</b>\n\nUser: {user_mention}",
-                    reply_markup=keyboard,
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logging.error(f"Failed to send to admin {admin['user_id']}: {e}")
+@lru_cache(maxsize=4096)
+def line_keyboard(user_id: int):
+    """OTP / No Answer buttons sent with a new line"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="OTP 📞", callback_data=f"otp_{user_id}"),
+            InlineKeyboardButton(text="No Answer ❌", callback_data=f"noanswer_{user_id}"),
+        ]
+    ])
+
+
+@lru_cache(maxsize=4096)
+def on_call_keyboard(user_id: int):
+    """Follow-up actions once the agent is on call"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Need a Pass ⛹️", callback_data=f"need_pass_{user_id}")],
+        [InlineKeyboardButton(text="Needs an email 📧", callback_data=f"need_email_{user_id}")],
+        [InlineKeyboardButton(text="Finishing 🫡", callback_data=f"finishing_{user_id}")],
+        [InlineKeyboardButton(text="Vic Needs Callback ☎️", callback_data=f"vic_callback_{user_id}")],
+        [InlineKeyboardButton(text="Call Ended 📵", callback_data=f"call_ended_{user_id}")]
+    ])
+
+
+async def check_line_eligibility(bot: Bot, user_id: int, reply) -> bool:
+    """Gate checks shared by the Line button and the group command.
+    Sends the refusal through `reply` and returns False if the user can't get a line."""
+    # Bot status doesn't depend on the membership check; start the DB read now so it
+    # overlaps with it instead of running after
+    status_task = asyncio.create_task(run_db(get_bot_status))
+    try:
+        # 1) CHECK: in group?
+        try:
+            member_status = await get_member_status(bot, user_id)
+        except Exception:
+            member_status = "left"
+        if member_status == "kicked":
+            await reply("⚠️ You're blocked from the group!")
+            return False
+        if member_status == "left":
+            await reply("⚠️ Join the group first!")
+            return False
+
+        # 2) CHECK: bot running?
+        if await status_task == "stopped":
+            await reply("⏸️ Bot is currently stopped.")
+            return False
+
+        # 3) CHECK: user already has active line?
+        if await run_db(has_active_line, user_id):
+            await reply("❌ You already have an active line! Use it first.")
+            return False
 
+        return True
+    finally:
+        # No-op once awaited; drops the prefetch when a gate check bails out early
+        status_task.cancel()
 
 
 @router.callback_query(F.data == "request_line")
@@ -2044,122 +2711,74 @@ async def callback_request_line(callback: CallbackQuery, state: FSMContext, bot:
     user_id = callback.from_user.id
     username = callback.from_user.username or callback.from_user.first_name
 
-    # 1) CHECK: in group?
-    try:
-        member = await bot.get_chat_member(GROUP_CHAT_ID, user_id)
-        if member.status == "kicked":
-            await callback.message.answer("⚠️ You're blocked from the group!")
-            await callback.answer()
-            return
-        if member.status == "left":
-            await callback.message.answer("⚠️ Join the group first!")
-            await callback.answer()
-            return
-    except Exception:
-        await callback.message.answer("⚠️ Join the group first!")
+    if not await check_line_eligibility(bot, user_id, callback.message.answer):
         await callback.answer()
         return
 
-    # 2) CHECK: bot running?
-    status = get_bot_status()
-    if status == "stopped":
-        await callback.message.answer("⏸️ Bot is currently stopped.", parse_mode="HTML")
-        await callback.answer()
-        return
-
-    loop = asyncio.get_event_loop()
-
-    # 3) CHECK: user already has active line?
-    def has_active_line(uid: int) -> bool:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """
-                    SELECT id FROM number_queue
-                    WHERE used_by_user_id = %s
-                      AND is_used = TRUE
-                      AND is_completed = FALSE
-                    LIMIT 1
-                    """,
-                    (uid,),
-                )
-                return cursor.fetchone() is not None
+    # 4) DIRECTLY assign next number (no number_requests / no approval)
+    # The open-line check is repeated as a locking read inside the claim transaction,
+    # so two quick presses can't both pass the gate above and each claim a line
+    record = await run_db(get_next_number, user_id, username, False)
 
-    already_has_line = await loop.run_in_executor(None, has_active_line, user_id)
-    if already_has_line:
-        await callback.message.answer(
-            "❌ You already have an active line! Use it first."
-        )
+    if record is HAS_OPEN_LINE:
+        await callback.message.answer("❌ You already have an active line! Use it first.")
         await callback.answer()
         return
 
-    # 4) DIRECTLY assign next number (no number_requests / no approval)
-    record = await loop.run_in_executor(
-        None, get_next_number, user_id, username, False
-    )
-
     if not record:
         await callback.message.answer("❌ No numbers available in queue right now.")
         await callback.answer()
         return
 
-    # 5) Get agent name + reference
-    user_info = await loop.run_in_executor(None, get_user_info, user_id)
-    agent_name = (
-        user_info["agent_name"]
-        if user_info and user_info.get("agent_name")
-        else "Agent"
-    )
-    reference = user_info["reference"] if user_info else REFERENCE
+    # Fresh line, fresh status trail
+    _line_status.pop(user_id, None)
+
+    # 5) Agent name + reference came back with the line
+    agent_name = record["agent_name"] or "Agent"
+    reference = record["reference"] or REFERENCE
 
     # 6) Build DM text properly
-    dm_message = ""
-    dm_message += f"👤 <b>Agent:</b> {agent_name}\n"
-    dm_message += f"🗃️ Reference: <code>{reference}</code>\n\n"
-    dm_message += "🎫 <b>Your Line:</b>\n\n"
+    parts = [
+        f"👤 <b>Agent:</b> {agent_name}\n",
+        f"🗃️ Reference: <code>{reference}</code>\n\n",
+        "🎫 <b>Your Line:</b>\n\n",
+    ]
 
     # Personal Info
     if record.get("name"):
-        dm_message += f"👤 Name: {record['name']}\n"
+        parts.append(f"👤 Name: {record['name']}\n")
     if record.get("dob"):
-        dm_message += f"📅 DOB: {record['dob']}\n"
+        parts.append(f"📅 DOB: {record['dob']}\n")
     if record.get("mmn"):
-        dm_message += f"👩 MMN: {record['mmn']}\n"
-        
-    dm_message += f"📞 Number: <code>{record['number']}</code>\n"
-    
+        parts.append(f"👩 MMN: {record['mmn']}\n")
+
+    parts.append(f"📞 Number: <code>{record['number']}</code>\n")
+
     if record.get("address"):
-        dm_message += f"📍 Address: {record['address']}\n"
+        parts.append(f"📍 Address: {record['address']}\n")
     if record.get("email"):
-        dm_message += f"📧 Email: {record['email']}\n"
+        parts.append(f"📧 Email: {record['email']}\n")
 
     # Card Info
     if record.get("card_number"):
-        dm_message += "\n💳 <b>Card Details:</b>\n"
-        dm_message += f"Card Holder: {record.get('card_holder') or '-'}\n"
-        dm_message += f"CC: <code>{record.get('card_number')}</code>\n"
-        dm_message += f"Exp: {record.get('card_expiry') or '-'}\n"
-        dm_message += f"CVV: {record.get('cvv') or '-'}\n"
+        parts.append(
+            "\n💳 <b>Card Details:</b>\n"
+            f"Card Holder: {record.get('card_holder') or '-'}\n"
+            f"CC: <code>{record.get('card_number')}</code>\n"
+            f"Exp: {record.get('card_expiry') or '-'}\n"
+            f"CVV: {record.get('cvv') or '-'}\n"
+        )
         if record.get('sortcode'):
-            dm_message += f"Sort: {record.get('sortcode')}\n"
+            parts.append(f"Sort: {record.get('sortcode')}\n")
         if record.get('account_number'):
-            dm_message += f"Acc: {record.get('account_number')}\n"
+            parts.append(f"Acc: {record.get('account_number')}\n")
         if record.get('bin_info'):
-            dm_message += f"BIN: {record.get('bin_info')}\n"
+            parts.append(f"BIN: {record.get('bin_info')}\n")
+
+    dm_message = "".join(parts)
 
     # 7) OTP / No Answer buttons
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="OTP 📞", callback_data=f"otp_{user_id}"
-                ),
-                InlineKeyboardButton(
-                    text="No Answer ❌", callback_data=f"noanswer_{user_id}"
-                ),
-            ]
-        ]
-    )
+    keyboard = line_keyboard(user_id)
 
     try:
         # DM to user
@@ -2172,17 +2791,15 @@ async def callback_request_line(callback: CallbackQuery, state: FSMContext, bot:
 
         # Notify group
         user_mention = f"@{username}" if username else f"User {user_id}"
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"✅ {user_mention} line has been sent in private",
-            parse_mode="HTML",
-        )
+        notify_group_digest(f"✅ {user_mention} line has been sent in private")
 
         logging.info(
             f"User {username} ({user_id}) received line: {record['number']}"
         )
     except TelegramForbiddenError:
-        await bot.send_message(
+        await best_effort(
+            f"Warning admin about {user_id}",
+            bot.send_message,
             chat_id=ADMIN_ID,
             text=(
                 f"⚠️ Can't send DM to {username}. "
@@ -2200,16 +2817,15 @@ async def callback_request_line(callback: CallbackQuery, state: FSMContext, bot:
 # DECLINE LINE
 @router.callback_query(F.data.startswith("decline_line_"))
 async def callback_decline_line(callback: CallbackQuery, bot: Bot):
-    loop = asyncio.get_event_loop()
 
     # Check if user is admin
-    if not await loop.run_in_executor(None, is_admin, callback.from_user.id):
+    if not is_admin(callback.from_user.id):
         await callback.answer("❌ Admin only!", show_alert=True)
         return
 
-    request_id = int(callback.data.split("_")[2])
+    request_id = int(callback.data.rpartition("_")[2])
 
-    request = await loop.run_in_executor(None, get_request_by_id, request_id)
+    request = await run_db(get_request_by_id, request_id)
 
     if not request:
         await callback.answer("❌ Not found or already processed!", show_alert=True)
@@ -2234,33 +2850,21 @@ async def callback_decline_line(callback: CallbackQuery, bot: Bot):
     username = request['username']
     user_mention = f"@{username}" if username else f"User {user_id}"
 
-    # Update request status
-    await loop.run_in_executor(None, update_request_status, request_id, "declined")
-
-    # Delete the request
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("DELETE FROM number_requests WHERE id = %s", (request_id,))
+    # Declined requests are deleted outright, so no status update is needed first;
+    # the pending guard makes a double-click by two admins a no-op
+    if not await run_db(decline_request, request_id):
+        await callback.answer("⚠️ Already processed!", show_alert=True)
+        return
 
     # Notify user in DM
-    try:
-        await bot.send_message(
-            chat_id=user_id,
-            text="❌ <b>Your line request was denied by admin.</b>\n\nMessage in the group to find out why.",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error notifying user: {e}")
+    enqueue_message(
+        user_id,
+        "❌ <b>Your line request was denied by admin.</b>\n\nMessage in the group to find out why.",
+        parse_mode="HTML"
+    )
 
     # Notify group
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"❌ {user_mention}'s line request has been declined",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error notifying group: {e}")
+    notify_group(f"❌ {user_mention}'s line request has been declined")
 
     # Delete the decline message for all admins
     try:
@@ -2278,10 +2882,9 @@ async def callback_undo_decline_line(callback: CallbackQuery, bot: Bot):
         await callback.answer("Admin only!", show_alert=True)
         return
 
-    request_id = int(callback.data.split("_")[3])
+    request_id = int(callback.data.rpartition("_")[2])
 
-    loop = asyncio.get_event_loop()
-    request = await loop.run_in_executor(None, get_request_by_id, request_id)
+    request = await run_db(get_request_by_id, request_id)
 
     if not request:
         await callback.answer("Not found!", show_alert=True)
@@ -2291,164 +2894,77 @@ async def callback_undo_decline_line(callback: CallbackQuery, bot: Bot):
     username = request['username']
     user_mention = f"@{username}" if username else f"User {user_id}"
 
-    # Mark their old line as unused so they can request new one
-    def mark_old_line_unused(user_id):
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """UPDATE number_queue 
-                       SET is_used = FALSE, 
-                           used_by_user_id = NULL, 
-                           used_by_username = NULL,
-                           status = NULL,
-                           call_summary = NULL
-                       WHERE used_by_user_id = %s""",
-                    (user_id,)
-                )
-
-    await loop.run_in_executor(None, mark_old_line_unused, user_id)
-
-    # Update request status to approved
-    await loop.run_in_executor(None, update_request_status, request_id, "approved")
+    # Free their old line and approve the request
+    await run_db(approve_after_decline, request_id, user_id)
+    _line_status.pop(user_id, None)
 
     # Notify user in DM to request new line
-    try:
-        await bot.send_message(
-            chat_id=user_id,
-            text="✅ <b>Your request has been approved!</b>\n\nClick /start and use the Line button to request your new line.",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error notifying user: {e}")
+    enqueue_message(
+        user_id,
+        "✅ <b>Your request has been approved!</b>\n\nClick /start and use the Line button to request your new line.",
+        parse_mode="HTML"
+    )
 
     # Notify group
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"✅ {user_mention}'s line request has been approved. They can now request their line.",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error notifying group: {e}")
+    notify_group(f"✅ {user_mention}'s line request has been approved. They can now request their line.")
 
-    await callback.message.edit_text(
-        f"{callback.message.text}\n\n✅ <b>APPROVED</b>",
-        parse_mode="HTML"
-    )
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await callback.message.reply("✅ <b>APPROVED</b>", parse_mode="HTML")
     await callback.answer("Undone!")
 
 
 # OTP CALLBACK
-@router.callback_query(F.data.startswith("otp_"))
-async def callback_otp(callback: CallbackQuery, bot: Bot):
-    user_id = int(callback.data.split("_")[1])
-
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
-
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, update_record_status, user_id, "OTP")
+async def callback_otp(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
+    track_status(user_id, "OTP")
 
     username = callback.from_user.username or callback.from_user.first_name
-    user_mention = callback.from_user.mention_html()
-
-    # Get user's current line details
-    record = await loop.run_in_executor(None, get_user_record, user_id)
-
-    # Get user agent name and reference
-    user_info = await loop.run_in_executor(None, get_user_info, user_id)
-    agent_name = user_info['agent_name'] if user_info and user_info.get('agent_name') else "Agent"
-    reference = user_info['reference'] if user_info else "CB2061"
+    user_mention = mention_html(callback.from_user)
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Need a Pass ⛹️", callback_data=f"need_pass_{user_id}")],
-        [InlineKeyboardButton(text="Needs an email 📧", callback_data=f"need_email_{user_id}")],
-        [InlineKeyboardButton(text="Finishing 🫡", callback_data=f"finishing_{user_id}")],
-        [InlineKeyboardButton(text="Vic Needs Callback ☎️", callback_data=f"vic_callback_{user_id}")],
-        [InlineKeyboardButton(text="Call Ended 📵", callback_data=f"call_ended_{user_id}")]
-    ])
+    keyboard = on_call_keyboard(user_id)
 
-    await callback.message.edit_text(
-        f"{callback.message.text}\n\n✅ Status: OTP 📞\n\nWhat do you need?",
-        reply_markup=keyboard
-    )
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await callback.message.reply("✅ Status: OTP 📞\n\nWhat do you need?", reply_markup=keyboard)
 
-    # Send line details to ALL admins
+    # Send line details to ALL admins; agent info is only looked up when there is a line to send
+    record = await run_db(get_user_record, user_id)
     if record:
-        admin_message = f"📲 <b>{user_mention} is on call (OTP)</b>\n\n"
-        admin_message += f"👤 <b>Agent:</b> {agent_name}\n"
-        admin_message += f"🗃️ Reference: <code>{reference}</code>\n\n\n"
-        admin_message += f"<b>🎫Line Details:</b>\n\n"
-
-
+        user_info = await run_db(get_user_info, user_id)
+        agent_name = user_info['agent_name'] if user_info and user_info.get('agent_name') else "Agent"
+        reference = user_info['reference'] if user_info else "CB2061"
+
+        parts = [
+            f"📲 <b>{user_mention} is on call (OTP)</b>\n\n"
+            f"👤 <b>Agent:</b> {agent_name}\n"
+            f"🗃️ Reference: <code>{reference}</code>\n\n\n"
+            "<b>🎫Line Details:</b>\n\n"
+        ]
         if record.get('name'):
-            admin_message += f"👤 Name: {record['name']}\n"
-        admin_message += f"📞 Number: <code>{record['number']}</code>\n"
+            parts.append(f"👤 Name: {record['name']}\n")
+        parts.append(f"📞 Number: <code>{record['number']}</code>\n")
         if record.get('address'):
-            admin_message += f"📍 Address: {record['address']}\n"
+            parts.append(f"📍 Address: {record['address']}\n")
         if record.get('email'):
-            admin_message += f"📧 Email: {record['email']}\n"
+            parts.append(f"📧 Email: {record['email']}\n")
+        admin_message = "".join(parts)
 
-        # Send to master admin
-        try:
-            await bot.send_message(
-                chat_id=ADMIN_ID,
-                text=admin_message,
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logging.error(f"Error sending to master admin: {e}")
-
-        # Send to all other admins
-        admins = await loop.run_in_executor(None, get_all_admins)
-        for admin in admins:
-            if admin['user_id'] != ADMIN_ID:
-                try:
-                    await bot.send_message(
-                        chat_id=admin['user_id'],
-                        text=admin_message,
-                        parse_mode="HTML"
-                    )
-                except Exception as e:
-                    logging.error(f"Error sending to admin {admin['user_id']}: {e}")
+        await broadcast_to_admins(admin_message)
 
     # Notify group
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"📲 {user_mention} is on call"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
+    notify_group(f"📲 {user_mention} is on call")
 
     await callback.answer()
 
 
 # CALL ENDED CALLBACK - Ask for summary
-@router.callback_query(F.data.startswith("call_ended_"))
-async def callback_call_ended(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user_id = int(callback.data.split("_")[2])
+async def callback_call_ended(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
+    user_mention = mention_html(callback.from_user)
 
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
-
-    username = callback.from_user.username or callback.from_user.first_name
-    user_mention = callback.from_user.mention_html()
-
-    # Notify group immediately
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"📵 {user_mention} call ended"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
+    # Notify group (next digest)
+    notify_group_digest(f"📵 {user_mention} call ended")
 
     # Ask for summary
     await state.set_state(UserStates.waiting_for_call_ended_summary)
-    await state.update_data(user_id=user_id, username=username)
+    await state.update_data(ctx=(user_id, False))
 
     await callback.message.answer(
         "📝 Enter summary for this call:\n\nSend /cancel to abort.",
@@ -2457,73 +2973,12 @@ async def callback_call_ended(callback: CallbackQuery, state: FSMContext, bot: B
     await callback.answer()
 
 
-@router.message(UserStates.waiting_for_call_ended_summary, F.text)
-async def receive_call_ended_summary(message: Message, state: FSMContext, bot: Bot):
-
-
-    data = await state.get_data()
-    user_id = data.get('user_id')
-    username = data.get('username')
-    summary_text = message.text
-
-    loop = asyncio.get_event_loop()
-    if message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Cancelled.")
-        await loop.run_in_executor(None, mark_line_completed, user_id)
-        return
-
-    await loop.run_in_executor(None, mark_line_completed, user_id)
-    await loop.run_in_executor(None, increment_score, user_id)
-
-    # Send summary to group (but don't save)
-    try:
-        user_mention = message.from_user.mention_html()
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"📝 <b>{user_mention}'s Call Summary:</b>\n\n{summary_text}",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
-
-    # Show button to request new line
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Request New Line 🔄", callback_data=f"request_line")]
-    ])
-
-    await message.answer(
-        "✅ <b>Summary sent to group!</b>\n\n"
-        "You can now request a new line if needed.",
-        parse_mode="HTML",
-        reply_markup=keyboard
-    )
-
-    await state.clear()
-
-
-
-
 # FINISHING CALLBACK - Ask for summary
-@router.callback_query(F.data.startswith("finishing_"))
-async def callback_finishing(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user_id = int(callback.data.split("_")[1])
-
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
-
-    username = callback.from_user.username or callback.from_user.first_name
-    user_mention = callback.from_user.mention_html()
+async def callback_finishing(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
+    user_mention = mention_html(callback.from_user)
 
     # Notify group
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"🫡 {user_mention} is finishing call"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
+    notify_group_digest(f"🫡 {user_mention} is finishing call")
 
     # Tell user
     await callback.message.answer(
@@ -2533,80 +2988,21 @@ async def callback_finishing(callback: CallbackQuery, state: FSMContext, bot: Bo
 
     # Set state to wait for finishing summary
     await state.set_state(UserStates.waiting_for_finishing_summary)
-    await state.update_data(user_id=user_id, username=username)
+    await state.update_data(ctx=(user_id, False))
 
     await callback.answer()
 
 
-# RECEIVE FINISHING SUMMARY
-@router.message(UserStates.waiting_for_finishing_summary, F.text)
-async def receive_finishing_summary(message: Message, state: FSMContext, bot: Bot):
-    if message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Cancelled.")
-        return
-
-    data = await state.get_data()
-    user_id = data.get('user_id')
-    username = data.get('username')
-    summary_text = message.text
-
-    loop = asyncio.get_event_loop()
-
-    await loop.run_in_executor(None, mark_line_completed, user_id)
-    await loop.run_in_executor(None, increment_score, user_id)
-
-    # Send summary to group (but don't save)
-    try:
-        user_mention = message.from_user.mention_html()
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"🫡 <b>{user_mention} finishing call</b>\n\n📝 <b>Summary:</b>\n{summary_text}",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
-
-    # Show button to request new line
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Request New Line 🔄", callback_data=f"request_line")]
-    ])
-
-    await message.answer(
-        "✅ <b>Finishing summary sent to group!</b>\n\n"
-        "You can now request a new line if needed.",
-        parse_mode="HTML",
-        reply_markup=keyboard
-    )
-
-    await state.clear()
-
-
-
 # VIC NEEDS CALLBACK - Ask for summary
-@router.callback_query(F.data.startswith("vic_callback_"))
-async def callback_vic_callback(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user_id = int(callback.data.split("_")[2])
-
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
-
-    username = callback.from_user.username or callback.from_user.first_name
-    user_mention = callback.from_user.mention_html()
+async def callback_vic_callback(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
+    user_mention = mention_html(callback.from_user)
 
-    # Notify group immediately
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"☎️ {user_mention} needs a call back"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
+    # Notify group (next digest)
+    notify_group_digest(f"☎️ {user_mention} needs a call back")
 
     # Ask for summary
     await state.set_state(UserStates.waiting_for_callback_summary)
-    await state.update_data(user_id=user_id, username=username)
+    await state.update_data(ctx=(user_id, False))
 
     await callback.message.answer(
         "📝 Enter summary for callback:\n\nSend /cancel to abort.",
@@ -2615,46 +3011,43 @@ async def callback_vic_callback(callback: CallbackQuery, state: FSMContext, bot:
     await callback.answer()
 
 
-# RECEIVE CALLBACK SUMMARY
-@router.message(UserStates.waiting_for_callback_summary, F.text)
-async def receive_callback_summary(message: Message, state: FSMContext, bot: Bot):
-    data = await state.get_data()
-    user_id = data.get('user_id')
-    username = data.get('username')
-    summary_text = message.text
+# Summary states keep ctx=(user_id, need_pass) in FSM data.
+# Summaries that are only posted to the group (not saved): state -> (group message, confirmation)
+SUMMARY_CONFIG = {
+    UserStates.waiting_for_call_ended_summary.state: (
+        "📝 <b>{mention}'s Call Summary:</b>\n\n{summary}",
+        "✅ <b>Summary sent to group!</b>",
+    ),
+    UserStates.waiting_for_finishing_summary.state: (
+        "🫡 <b>{mention} finishing call</b>\n\n📝 <b>Summary:</b>\n{summary}",
+        "✅ <b>Finishing summary sent to group!</b>",
+    ),
+    UserStates.waiting_for_callback_summary.state: (
+        "☎️ <b>{mention} needs callback</b>\n\n📝 <b>Summary:</b>\n{summary}",
+        "✅ <b>Callback summary sent to group!</b>",
+    ),
+}
 
-    loop = asyncio.get_event_loop()
-    if message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Cancelled.")
-        await loop.run_in_executor(None, mark_line_completed, user_id)
+
+# RECEIVE CALL ENDED / FINISHING / CALLBACK SUMMARY
+@router.message(StateFilter(*SUMMARY_CONFIG), F.text)
+async def receive_group_summary(message: Message, state: FSMContext, bot: Bot):
+    group_template, confirmation = SUMMARY_CONFIG[await state.get_state()]
+    ctx = await get_summary_ctx(message, state)
+    if ctx is None:
         return
+    user_id, _ = ctx
 
-    # Mark line as available (but DON'T save to call_backs table)
-    await loop.run_in_executor(None, mark_line_completed, user_id)
-    await loop.run_in_executor(None, increment_score, user_id)
+    # Mark line as available (summary is not saved)
+    await complete_line(user_id)
 
-    # Send summary to group (but don't save)
-    try:
-        user_mention = message.from_user.mention_html()
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"☎️ <b>{user_mention} needs callback</b>\n\n📝 <b>Summary:</b>\n{summary_text}",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
-
-    # Show button to request new line
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Request New Line 🔄", callback_data=f"request_line")]
-    ])
+    notify_group(group_template.format(mention=mention_html(message.from_user), summary=message.text))
 
     await message.answer(
-        "✅ <b>Callback summary sent to group!</b>\n\n"
+        f"{confirmation}\n\n"
         "You can now request a new line if needed.",
         parse_mode="HTML",
-        reply_markup=keyboard
+        reply_markup=REQUEST_NEW_LINE_KB
     )
 
     await state.clear()
@@ -2664,46 +3057,14 @@ async def receive_callback_summary(message: Message, state: FSMContext, bot: Bot
 
 @router.message(Command("export_callbacks"), F.chat.type == "private", F.from_user.id == ADMIN_ID)
 async def cmd_export_callbacks(message: Message, bot: Bot):
-    loop = asyncio.get_event_loop()
-
-    def get_all_callbacks():
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """SELECT user_id, username, number, name, address, email, call_summary, created_at 
-                       FROM call_backs ORDER BY created_at DESC"""
-                )
-                return cursor.fetchall()
-
-    callbacks = await loop.run_in_executor(None, get_all_callbacks)
-
-    if not callbacks:
-        await message.answer("No callbacks found!")
-        return
+    with export_tempfile() as path:
+        if not await run_db(export_callbacks, path):
+            await message.answer("No callbacks found!")
+            return
 
-    # Create CSV
-    file_path = "/tmp/callbacks.csv"
-    with open(file_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['User ID', 'Username', 'Number', 'Name', 'Address', 'Email', 'Summary', 'Date'])
-        for cb in callbacks:
-            writer.writerow([
-                cb['user_id'],
-                cb['username'],
-                cb['number'],
-                cb['name'],
-                cb['address'],
-                cb['email'],
-                cb['call_summary'],
-                cb['created_at']
-            ])
-
-    # Send file
-    document = FSInputFile(file_path)
-    with open(file_path, 'rb') as f:
         await bot.send_document(
             chat_id=message.from_user.id,
-            document=document,
+            document=FSInputFile(path, filename="callbacks.csv"),
             caption="📋 Callback Records"
         )
 
@@ -2711,29 +3072,16 @@ async def cmd_export_callbacks(message: Message, bot: Bot):
 
 
 # NEED A PASS CALLBACK
-@router.callback_query(F.data.startswith("need_pass_"))
-async def callback_need_pass(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user_id = int(callback.data.split("_")[2])
-
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
+async def callback_need_pass(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
+    user_mention = mention_html(callback.from_user)
 
-    username = callback.from_user.username or callback.from_user.first_name
-    user_mention = callback.from_user.mention_html()
+    track_status(user_id, "Need Pass")
 
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"⛹️ {user_mention} needs a pass",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
+    notify_group_digest(f"⛹️ {user_mention} needs a pass")
 
     # Ask for summary
     await state.set_state(UserStates.waiting_for_summary)
-    await state.update_data(user_id=user_id, need_pass=True)
+    await state.update_data(ctx=(user_id, True))
 
     await callback.message.answer(
         "📝 <b>Enter your summary before requesting another pass:</b>\n\nSend /cancel to abort.",
@@ -2743,32 +3091,16 @@ async def callback_need_pass(callback: CallbackQuery, state: FSMContext, bot: Bo
     await callback.answer()
 
 # NEEDS EMAIL CALLBACK
-@router.callback_query(F.data.startswith("need_email_"))
-async def callback_need_email(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user_id = int(callback.data.split("_")[2])
-
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
+async def callback_need_email(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
+    user_mention = mention_html(callback.from_user)
 
-    username = callback.from_user.username or callback.from_user.first_name
-    user_mention = callback.from_user.mention_html()
+    track_status(user_id, "Need Email")
 
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, update_record_status, user_id, "Need Email")
-
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"📧 <b>User needs email sent</b>\n\n{user_mention}",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
+    notify_group(f"📧 <b>User needs email sent</b>\n\n{user_mention}")
 
     # Ask for summary (same as need_pass)
     await state.set_state(UserStates.waiting_for_summary)
-    await state.update_data(user_id=user_id, need_pass=False)  # need_pass=False for email
+    await state.update_data(ctx=(user_id, False))  # need_pass=False for email
 
     await callback.message.answer(
         "📝 <b>Enter your summary before requesting another email:</b>\n\nSend /cancel to abort.",
@@ -2779,34 +3111,24 @@ async def callback_need_email(callback: CallbackQuery, state: FSMContext, bot: B
 
 
 # NO ANSWER CALLBACK
-@router.callback_query(F.data.startswith("noanswer_"))
-async def callback_noanswer(callback: CallbackQuery, bot: Bot):
-    user_id = int(callback.data.split("_")[1])
-
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
-
-    loop = asyncio.get_event_loop()
-
+async def callback_noanswer(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
     # STEP 1: Update status
-    await loop.run_in_executor(None, update_record_status, user_id, "No Answer")
+    track_status(user_id, "No Answer")
 
     # STEP 2: Get record BEFORE marking completed ✅
-    record = await loop.run_in_executor(None, get_user_record, user_id)
+    record = await run_db(get_user_record, user_id)
 
     username = callback.from_user.username or callback.from_user.first_name
-    user_mention = callback.from_user.mention_html()
+    user_mention = mention_html(callback.from_user)
 
     # STEP 3: Get user agent name and reference
-    user_info = await loop.run_in_executor(None, get_user_info, user_id)
+    user_info = await run_db(get_user_info, user_id)
     agent_name = user_info['agent_name'] if user_info and user_info.get('agent_name') else "Agent"
     reference = user_info['reference'] if user_info else REFERENCE
 
     # STEP 4: Save no answer record (while we still have the data)
     if record:
-        await loop.run_in_executor(
-            None,
+        await run_db(
             save_no_answer_record,
             user_id,
             username,
@@ -2819,35 +3141,23 @@ async def callback_noanswer(callback: CallbackQuery, bot: Bot):
         )
 
     # STEP 5: NOW mark line as completed ✅
-    await loop.run_in_executor(None, mark_line_completed, user_id)
+    await complete_line(user_id, add_score=False)
 
     # STEP 6: Notify gr
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Request Another Line 🔄", callback_data="request_line")]
-    ])
+    keyboard = REQUEST_ANOTHER_LINE_KB
 
-    await callback.message.edit_text(
-        f"{callback.message.text}\n\n❌ <b>No Answer</b>\n\nRequest another:",
-        parse_mode="HTML",
-        reply_markup=keyboard
-    )
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await callback.message.reply("❌ <b>No Answer</b>\n\nRequest another:", parse_mode="HTML", reply_markup=keyboard)
 
     await callback.answer()
 
 
 
 # SUMMARY CALLBACK
-@router.callback_query(F.data.startswith("summary_"))
-async def callback_summary(callback: CallbackQuery, state: FSMContext):
-    user_id = int(callback.data.split("_")[1])
-
-    if callback.from_user.id != user_id:
-        await callback.answer("Not for you!", show_alert=True)
-        return
-
+async def callback_summary(callback: CallbackQuery, state: FSMContext, bot: Bot, user_id: int):
     await state.set_state(UserStates.waiting_for_summary)
-    await state.update_data(user_id=user_id)
+    await state.update_data(ctx=(user_id, False))
 
     await callback.message.answer(
         "📝 <b>Enter your call summary:</b>\n\nSend /cancel to abort.",
@@ -2857,55 +3167,56 @@ async def callback_summary(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+# Per-line buttons carry "<action>_<user_id>"; one handler checks ownership and routes them all
+LINE_ACTIONS = {
+    "otp": callback_otp,
+    "call_ended": callback_call_ended,
+    "finishing": callback_finishing,
+    "vic_callback": callback_vic_callback,
+    "need_pass": callback_need_pass,
+    "need_email": callback_need_email,
+    "noanswer": callback_noanswer,
+    "summary": callback_summary,
+}
+LINE_ACTION_RE = re.compile(rf"^({'|'.join(LINE_ACTIONS)})_(\d+)$")
+
+
+@router.callback_query(F.data.regexp(LINE_ACTION_RE).as_("action_match"))
+async def callback_line_action(callback: CallbackQuery, state: FSMContext, bot: Bot, action_match: re.Match):
+    action, user_id = action_match.groups()
+    # Buttons only work for the agent the line belongs to
+    if user_id != str(callback.from_user.id):
+        return await callback.answer("Not for you!", show_alert=True)
+    await LINE_ACTIONS[action](callback, state, bot, callback.from_user.id)
+
+
 # RECEIVE SUMMARY
 @router.message(UserStates.waiting_for_summary, F.text)
 async def receive_summary(message: Message, state: FSMContext, bot: Bot):
 
 
-    data = await state.get_data()
-    user_id = data.get('user_id')
-    need_pass = data.get('need_pass', False)
-    summary_text = message.text
-
-    loop = asyncio.get_event_loop()
-    if message.text.startswith('/cancel'):
-        await state.clear()
-        await message.answer("❌ Cancelled.")
-        await loop.run_in_executor(None, update_record_summary, user_id, summary_text)
-        await loop.run_in_executor(None, mark_line_completed, user_id)
+    ctx = await get_summary_ctx(message, state)
+    if ctx is None:
         return
+    user_id, need_pass = ctx
+    summary_text = message.text
 
-    await loop.run_in_executor(None, update_record_summary, user_id, summary_text)
-    await loop.run_in_executor(None, mark_line_completed, user_id)
-    await loop.run_in_executor(None, increment_score, user_id)
+    await complete_line(user_id, summary_text)
 
     username = message.from_user.username or message.from_user.first_name
-    user_mention = message.from_user.mention_html()
+    user_mention = mention_html(message.from_user)
 
     # Send summary to group
-    try:
-        await bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=f"📋 <b>Summary from {user_mention}</b>\n\n{summary_text}",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Error: {e}")
+    notify_group(f"📋 <b>Summary from {user_mention}</b>\n\n{summary_text}")
 
     if need_pass:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Request New Line 🔄", callback_data=f"request_line")]
-        ])
-
         await message.answer(
             "✅ <b>Summary submitted!</b>\n\nClick below to request a new line:",
             parse_mode="HTML",
-            reply_markup=keyboard
+            reply_markup=REQUEST_NEW_LINE_KB
         )
     else:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Request Another Line 🔄", callback_data=f"request_line")]
-        ])
+        keyboard = REQUEST_ANOTHER_LINE_KB
 
         await message.answer("✅ <b>Summary submitted!</b>", parse_mode="HTML", reply_markup=keyboard)
 
@@ -2919,19 +3230,42 @@ async def main():
     try:
         logging.info("📦 Initializing database...")
         init_database()
-        bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        asyncio.get_running_loop().set_default_executor(DEFAULT_EXECUTOR)
+        await warm_db_pool()
+        spawn_background(db_writer())
+        spawn_background(admin_refresher())
+        session_kwargs = {}
+        if orjson is not None:
+            session_kwargs = dict(
+                json_loads=orjson.loads,
+                json_dumps=lambda obj: orjson.dumps(obj).decode(),
+            )
+        # One shared session; its connection pool has to cover the outbox workers plus
+        # handlers sending concurrently during a burst
+        session = AiohttpSession(limit=BOT_API_CONNECTIONS, timeout=BOT_API_TIMEOUT, **session_kwargs)
+        bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        for _ in range(OUTBOX_WORKERS):
+            spawn_background(outbox_worker(bot))
+        spawn_background(group_digest_flusher())
         await set_bot_commands(bot)
         dp = Dispatcher(storage=MemoryStorage())
         dp.include_router(router)
 
         logging.info("🤖 Bot started!")
 
-        await dp.start_polling(bot)
+        # chat_member updates are opt-in, so request every type the router uses
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
     except Exception as e:
         logging.error(f"❌ Error: {e}")
         raise
+    finally:
+        DB_EXECUTOR.shutdown(wait=True)
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    # Pass the uvloop loop straight to the runner; uvloop.install() swaps the global
+    # event loop policy, which is deprecated from Python 3.12
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(main())
\ No newline at end of file
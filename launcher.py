@@ -2,56 +2,290 @@ import subprocess
 import sys
 import time
 import os
+import select
+import signal
+import importlib
+import multiprocessing
+import runpy
+import re
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import dotenv_values
 
 # --- CONFIGURATION ---
-# List the config files for all the bots you want to run
-BOT_CONFIGS = [
-    "configs/bot1.env",
-    "configs/bot2.env",
-    "configs/bot3.env",
-    "configs/bot4.env",
-    "configs/bot5.env"
-]
+# Bots are picked up from configs/botN.env; this launcher runs the N in BOT_NUMBERS
+CONFIG_DIR = Path("configs")
+BOT_NUMBERS = range(1, 6)  # bot1.env .. bot5.env
 
 PYTHON_EXEC = sys.executable  # Automatically finds the current python (venv or system)
 SCRIPT_NAME = "bot.py"  # Your main bot script name
+REQUIRED_KEYS = ("BOT_TOKEN", "ADMIN_ID", "GROUP_CHAT_ID", "DB_NAME")
+MIN_RESTART_INTERVAL = 1  # seconds; keeps a bot that dies on startup from spinning the CPU
+SHUTDOWN_GRACE = 5  # seconds bots get to exit after SIGTERM before they're SIGKILLed
 
+# Heavy libraries bot.py needs. They're imported once here and shared copy-on-write
+# with every forked bot instead of being re-imported by 10 fresh interpreters
+PRELOAD_MODULES = ("aiogram", "aiogram.client.session.aiohttp", "pymysql", "PIL.Image", "dotenv")
+use_fork = False
+# The monitor's epoll and pidfds; fork() doesn't honour CLOEXEC, so forked bots close these
+monitor_fds = set()
 
-def main():
-    processes = []
 
-    print(f"🚀 Starting {len(BOT_CONFIGS)} bots...")
+if hasattr(os, "fork"):
+    class BotProcess(multiprocessing.get_context("fork").Process):
+        """Forked bot with the bits of the Popen interface the monitors use"""
+
+        def poll(self):
+            return self.exitcode
+
+        def wait(self):
+            self.join()
+            return self.exitcode
 
+
+def preload():
+    """Import the bots' dependencies up front; returns False if forking isn't usable"""
+    if not hasattr(os, "fork"):
+        return False
     try:
-        # Start each bot as a separate subprocess
-        for config in BOT_CONFIGS:
-            if not os.path.exists(config):
-                print(f"⚠️ Config file not found: {config}")
-                continue
+        for module in PRELOAD_MODULES:
+            importlib.import_module(module)
+    except ImportError as e:
+        print(f"ℹ️ Preload failed ({e}), bots will start as separate interpreters")
+        return False
+    return True
 
-            print(f"   ▶️ Launching bot with {config}...")
 
-            # This is equivalent to running "python bot.py bot1.env" in terminal
-            p = subprocess.Popen([PYTHON_EXEC, SCRIPT_NAME, config])
-            processes.append(p)
+def run_bot(config):
+    # Same as "python bot.py <config>", but inside the already-warm forked interpreter.
+    # Own session/process group, like start_new_session=True below
+    os.setsid()
+    # Drop the launcher's monitor fds inherited through fork
+    for fd in monitor_fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    monitor_fds.clear()
+    sys.argv = [SCRIPT_NAME, config]
+    runpy.run_path(SCRIPT_NAME, run_name="__main__")
+
+
+def find_configs():
+    """List configs/botN.env for the wanted N in numeric order (bot2 before bot10)"""
+    found = {}
+    # One directory scan instead of a stat() per expected file
+    for path in CONFIG_DIR.glob("bot*.env"):
+        match = re.fullmatch(r"bot(\d+)", path.stem)
+        if match and int(match.group(1)) in BOT_NUMBERS:
+            found[int(match.group(1))] = str(path)
+
+    for number in BOT_NUMBERS:
+        if number not in found:
+            print(f"⚠️ Config file not found: {CONFIG_DIR / f'bot{number}.env'}")
+    return [found[number] for number in sorted(found)]
+
+
+def validate_config(config):
+    """Return a reason the config can't start a bot, or None if it looks usable"""
+    values = dotenv_values(config)
+    missing = [key for key in REQUIRED_KEYS if not values.get(key)]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    for key in ("ADMIN_ID", "GROUP_CHAT_ID"):
+        try:
+            int(values[key])
+        except ValueError:
+            return f"{key} is not a number"
+    return None
+
+
+def launch(config):
+    if use_fork:
+        p = BotProcess(target=run_bot, args=(config,), name=f"bot:{config}")
+        p.start()
+        return p
+
+    # This is equivalent to running "python bot.py bot1.env" in terminal.
+    # start_new_session gives the bot its own process group so shutdown can signal
+    # everything it spawned. close_fds=False skips the close-every-fd pass, which is
+    # safe because Python opens fds non-inheritable, so nothing leaks
+    return subprocess.Popen([PYTHON_EXEC, SCRIPT_NAME, config], close_fds=False, start_new_session=True)
+
+
+def signal_groups(processes, sig):
+    # Each bot leads its own process group (pgid == pid)
+    for p in processes:
+        try:
+            os.killpg(p.pid, sig)
+        except ProcessLookupError:
+            # A just-forked bot may not have called setsid() yet, so its group doesn't exist
+            try:
+                os.kill(p.pid, sig)
+            except ProcessLookupError:
+                pass
+
+
+def wait_for_exit(processes, timeout):
+    """Wait up to `timeout` seconds for the processes to exit; returns those still running"""
+    deadline = time.monotonic() + timeout
+    ep = None
+    pending = {}
+    try:
+        ep = select.epoll()
+        for p in processes:
+            fd = os.pidfd_open(p.pid)
+            pending[fd] = p
+            ep.register(fd, select.EPOLLIN)
+        while pending and (remaining := deadline - time.monotonic()) > 0:
+            for fd, _ in ep.poll(timeout=remaining):
+                ep.unregister(fd)
+                p = pending.pop(fd)
+                os.close(fd)
+                p.wait()
+        return list(pending.values())
+    except (AttributeError, OSError):
+        pass
+    finally:
+        # Close whatever was opened, including on a failure part way through setup
+        for fd in pending:
+            os.close(fd)
+        if ep is not None:
+            ep.close()
+
+    # No pidfd support (or a child already reaped): poll instead
+    while time.monotonic() < deadline:
+        if all(p.poll() is not None for p in processes):
+            break
+        time.sleep(0.1)
+    return [p for p in processes if p.poll() is None]
+
+
+def shutdown(processes):
+    """SIGTERM every bot's process group, then SIGKILL whatever is left after the grace period"""
+    running = [p for p in processes if p.poll() is None]
+    signal_groups(running, signal.SIGTERM)
+    stuck = wait_for_exit(running, SHUTDOWN_GRACE)
+    if stuck:
+        print(f"⚠️ {len(stuck)} bot(s) ignored SIGTERM, killing them")
+        signal_groups(stuck, signal.SIGKILL)
+        for p in stuck:
+            p.wait()
 
-        print(f"✅ All bots started! Press Ctrl+C to stop them all.")
 
-        # Keep the main script alive to monitor the bots
+def restart(config, processes, started):
+    """Relaunch a bot whose process ended (or never started); returns True on success"""
+    print(f"⚠️ Bot with {config} stopped/crashed. Restarting...")
+    delay = started.get(config, 0) + MIN_RESTART_INTERVAL - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    started[config] = time.monotonic()
+    try:
+        processes[config] = launch(config)
+        return True
+    except OSError as e:
+        processes.pop(config, None)
+        print(f"⚠️ Failed to restart {config}: {e}")
+        return False
+
+
+def monitor_polling(configs, processes, started):
+    """Fallback monitor: check every bot once a second"""
+    while True:
+        time.sleep(1)
+
+        for config in configs:
+            p = processes.get(config)
+            if p is None or p.poll() is not None:  # If process is not None, it ended
+                restart(config, processes, started)
+
+
+def monitor_pidfd(configs, processes, started):
+    """Block until a bot exits (Linux pidfd + epoll) and restart exactly that one"""
+    ep = select.epoll()
+    monitor_fds.add(ep.fileno())
+    watched = {}  # pidfd -> config
+
+    def watch(config):
+        fd = os.pidfd_open(processes[config].pid)
+        watched[fd] = config
+        monitor_fds.add(fd)
+        ep.register(fd, select.EPOLLIN)
+
+    try:
+        for config in configs:
+            if config in processes:
+                watch(config)
+
         while True:
-            time.sleep(1)
+            # Configs whose launch failed have no pidfd; wake up once a second to retry them
+            missing = [config for config in configs if config not in processes]
+            for fd, _ in ep.poll(timeout=1 if missing else -1):
+                config = watched.pop(fd)
+                monitor_fds.discard(fd)
+                ep.unregister(fd)
+                os.close(fd)
+                processes[config].wait()  # reap it
+                if restart(config, processes, started):
+                    watch(config)
+            for config in missing:
+                if restart(config, processes, started):
+                    watch(config)
+    finally:
+        # main() falls back to polling on OSError; don't leak the epoll or the pidfds
+        for fd in watched:
+            os.close(fd)
+        ep.close()
+        monitor_fds.clear()
+
+
+def main():
+    global use_fork
+    processes = {}
+    started = {}
+
+    # Check every config before launching anything, so a broken one is reported
+    # up front instead of crash-looping in the restart loop below. The files are
+    # read in parallel so a slow disk doesn't delay startup once per bot
+    bot_configs = find_configs()
+    with ThreadPoolExecutor(max_workers=len(bot_configs) or 1) as pool:
+        problems = list(pool.map(validate_config, bot_configs))
+
+    configs = []
+    for config, problem in zip(bot_configs, problems):
+        if problem:
+            print(f"⚠️ Skipping {config}: {problem}")
+        else:
+            configs.append(config)
+
+    # Fork only while the launcher is single-threaded (the config pool above has exited)
+    use_fork = preload()
+
+    print(f"🚀 Starting {len(configs)} bots...")
+
+    try:
+        # Start each bot as a separate subprocess
+        for config in configs:
+            print(f"   ▶️ Launching bot with {config}...")
+            started[config] = time.monotonic()
+            try:
+                processes[config] = launch(config)
+            except OSError as e:
+                print(f"⚠️ Failed to launch {config}: {e}")
 
-            # Optional: Check if a bot crashed and restart it
-            for i, p in enumerate(processes):
-                if p.poll() is not None:  # If process is not None, it ended
-                    print(f"⚠️ Bot with {BOT_CONFIGS[i]} stopped/crashed. Restarting...")
-                    processes[i] = subprocess.Popen([PYTHON_EXEC, SCRIPT_NAME, BOT_CONFIGS[i]])
+        print(f"✅ All bots started! Press Ctrl+C to stop them all.")
+
+        # Keep the main script alive to monitor the bots, restarting any that crash.
+        # pidfd_open needs Linux 5.3+; anywhere else fall back to polling
+        try:
+            monitor_pidfd(configs, processes, started)
+        except (AttributeError, OSError) as e:
+            print(f"ℹ️ Event-driven monitor unavailable ({e}), polling instead")
+            monitor_polling(configs, processes, started)
 
     except KeyboardInterrupt:
         print("\n🛑 Stopping all bots...")
-        for p in processes:
-            p.terminate()  # Sends SIGTERM
-            # p.kill()     # Use this if they refuse to close
+        shutdown(list(processes.values()))
         print("👋 All bots stopped.")
 
 